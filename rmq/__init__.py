@@ -1,2 +1,5 @@
 from rmq.rmqproducer.rabbitmq_producer import Publisher
 from rmq.rmqreceiver.rabbitmq_receiver import Receiver
+from rmq.rmqrpc.rpc_client import RpcClient
+from rmq.rmqrpc.rpc_server import RpcServer
+from rmq.rmqpipeline.pipeline_stage import PipelineStage
@@ -0,0 +1,333 @@
+import uuid
+import functools
+from collections import deque, OrderedDict
+
+import pika
+
+from rmq.rmqreceiver.rabbitmq_receiver import Receiver
+
+
+class PipelineStage(Receiver):
+    """Consume-transform-publish stage on a single connection and channel.
+
+    Every upstream message is passed to the transform, whose outputs are
+    published to the output exchange on the consuming channel with publisher
+    confirms enabled. Publishes are pipelined: the stage doesn't wait for the
+    confirmations, but an upstream message is only acknowledged once all of
+    its outputs have been confirmed. Upstream messages are acknowledged in
+    delivery order, with a single multiple-ack for every run of completed
+    messages whose delivery tags are contiguous and which no unsettled
+    message precedes, else one by one. For stream queues the offset only
+    moves on with the acknowledgements. If RabbitMQ rejects an output, its
+    upstream message is rejected (and requeued by default, after
+    requeue_delay) instead.
+
+    A crash therefore never loses a message, but may forward one twice. The
+    outputs of an upstream message with a message_id get the derived ids
+    <message_id>.<output index>, so that a downstream Receiver with a
+    dedup_cache drops such duplicates.
+
+    """
+
+    def __init__(self, transform, amqp_url, exchange, output_exchange, **kwargs):
+        """Create a new instance of the PipelineStage class. Takes the same
+        optional arguments as Receiver, plus:
+
+        :param method transform: The method to callback with every upstream
+                message, with the signature transform(channel, method,
+                properties, body). It returns a list of outputs, each a tuple
+                (routing_key, body) or (routing_key, body, properties) where
+                properties is a dictionary of pika.BasicProperties fields
+        :param str amqp_url: The AMQP url to connect with
+        :param str exchange: Name of the exchange to consume from
+        :param str output_exchange: Name of the exchange to publish outputs to
+        :param str output_exchange_type: The type of the output exchange. If no
+                value is given, it will assume that the exchange already exists
+        :param int max_inflight: Number of upstream messages in progress at a
+                time, used as prefetch count unless prefetch_count is given.
+                It's default value is 100
+        :param bool requeue_on_nack: Requeue an upstream message if one of its
+                outputs is rejected by RabbitMQ. It's default value is True
+        :param float requeue_delay: Seconds an upstream message whose output
+                was rejected is held before it is requeued, so that a
+                destination refusing messages isn't hammered with them. It's
+                default value is 1
+
+        """
+        for option in ('process_pool', 'transfer_callback', 'chunk_callback'):
+            if kwargs.get(option) is not None:
+                # those messages never reach the transform
+                raise ValueError('PipelineStage can\'t be combined with %s' % option)
+        self.transform = transform
+        self.output_exchange = output_exchange
+        self.output_exchange_type = kwargs.pop('output_exchange_type', None)
+        self.requeue_on_nack = kwargs.pop('requeue_on_nack', True)
+        self.requeue_delay = kwargs.pop('requeue_delay', 1)
+        max_inflight = kwargs.pop('max_inflight', 100)
+        kwargs.setdefault('prefetch_count', max_inflight)
+        kwargs['no_ack'] = False
+        Receiver.__init__(self, self.forward_message, amqp_url, exchange, **kwargs)
+        self.reset_pipeline()
+
+    def reset_pipeline(self):
+        """Forget the in progress messages. Invoked for every new channel,
+        since confirmation sequence numbers and delivery tags restart and
+        RabbitMQ redelivers the unacknowledged upstream messages.
+
+        """
+        # output sequence number -> upstream delivery tag, in publish order
+        self._outputs = OrderedDict()
+        # upstream delivery tags in delivery order
+        self._upstream_order = deque()
+        # upstream delivery tag -> number of unconfirmed outputs
+        self._pending_outputs = {}
+        self._transformed = set()
+        self._rejected = set()
+        # upstream delivery tag -> properties, whose message_id goes to the
+        # dedup cache and whose stream offset is recorded once the message is
+        # acknowledged
+        self._upstream_properties = {}
+        # delivery tags of upstream messages which aren't tracked any more
+        # but aren't settled yet either, e.g. failed transforms
+        self._unsettled = set()
+
+    def start_consuming(self):
+        """Enable publisher confirms and declare the output exchange if
+        needed before consuming.
+
+        """
+        self.reset_pipeline()
+        self.enable_confirms()
+        if self.output_exchange_type:
+            self._LOGGER.info('Declaring output exchange %s', self.output_exchange)
+            self._channel.exchange_declare(self.on_output_exchange_declareok,
+                                           self.output_exchange,
+                                           self.output_exchange_type, durable=True)
+        else:
+            Receiver.start_consuming(self)
+
+    def on_output_exchange_declareok(self, unused_frame):
+        """Invoked by pika when the output exchange has been declared.
+
+        :param pika.Frame.Method unused_frame: Exchange.DeclareOk response frame
+
+        """
+        self._LOGGER.info('Output exchange declared')
+        Receiver.start_consuming(self)
+
+    def forward_message(self, channel, basic_deliver, properties, body):
+        """Consumer callback transforming an upstream message and publishing
+        its outputs.
+
+        :param pika.channel.Channel channel: The channel object
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param str|unicode body: The message body
+
+        """
+        delivery_tag = basic_deliver.delivery_tag
+        self._upstream_order.append(delivery_tag)
+        self._pending_outputs[delivery_tag] = 0
+        try:
+            outputs = self.transform(channel, basic_deliver, properties, body) or []
+            for index, output in enumerate(outputs):
+                self.publish_output(delivery_tag, properties, index, *output)
+        except Exception:
+            # the message is not tracked any more: retry_message() (if there
+            # is a retry policy) settles it on its own, else it is redelivered
+            self._upstream_order.remove(delivery_tag)
+            del self._pending_outputs[delivery_tag]
+            self._unsettled.add(delivery_tag)
+            raise
+
+    def publish_output(self, delivery_tag, upstream_properties, index,
+                       routing_key, body, properties=None):
+        """Publish one output of an upstream message and remember which
+        upstream message it belongs to.
+
+        :param int delivery_tag: The delivery tag of the upstream message
+        :param pika.Spec.BasicProperties upstream_properties: The properties of
+                the upstream message
+        :param int index: The position of the output in the transform result
+        :param str routing_key: The routing key of the output
+        :param str body: The body of the output
+        :param dict properties: Extra pika.BasicProperties fields for the output
+
+        """
+        properties = dict(properties or {})
+        properties.setdefault('delivery_mode', 2)
+        if not properties.get('message_id'):
+            if upstream_properties.message_id:
+                properties['message_id'] = '%s.%d' % (upstream_properties.message_id, index)
+            else:
+                properties['message_id'] = uuid.uuid4().hex
+        self._channel.basic_publish(self.output_exchange, routing_key, body,
+                                    properties=pika.BasicProperties(**properties))
+        self._publish_number += 1
+        self._outputs[self._publish_number] = delivery_tag
+        self._pending_outputs[delivery_tag] += 1
+
+    def remember_message(self, basic_deliver, properties):
+        """Invoked by Receiver once the transform of an upstream message
+        returned. Its message_id only goes to the dedup cache when it is
+        acknowledged by settle_upstream, as a message rejected (and requeued)
+        or lost in a crash before that must not be skipped as a duplicate when
+        redelivered.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+
+        """
+        if basic_deliver.delivery_tag not in self._pending_outputs:
+            Receiver.remember_message(self, basic_deliver, properties)
+
+    def message_processed(self, basic_deliver, properties):
+        """Invoked by Receiver once the transform of an upstream message
+        returned. Its stream offset is only recorded when it is acknowledged
+        by settle_upstream, so that a restarted stage resumes before the
+        messages whose outputs weren't confirmed.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+
+        """
+        delivery_tag = basic_deliver.delivery_tag
+        if delivery_tag not in self._pending_outputs:
+            Receiver.message_processed(self, basic_deliver, properties)
+            return
+        self.messages_processed += 1
+        self._upstream_properties[delivery_tag] = properties
+        self.acknowledge_message(delivery_tag)
+
+    def retry_settled(self, basic_deliver, properties, confirmed):
+        """Invoked once the retry of an upstream message whose transform
+        failed is confirmed or rejected, which settles the message.
+
+        """
+        Receiver.retry_settled(self, basic_deliver, properties, confirmed)
+        self._unsettled.discard(basic_deliver.delivery_tag)
+
+    def acknowledge_message(self, delivery_tag):
+        """Invoked by Receiver once the transform of an upstream message
+        returned. The acknowledgement is deferred until its outputs are
+        confirmed. Messages which aren't tracked, e.g. skipped duplicates, are
+        acknowledged right away.
+
+        :param int delivery_tag: The delivery tag of the upstream message
+
+        """
+        if delivery_tag not in self._pending_outputs:
+            Receiver.acknowledge_message(self, delivery_tag)
+            return
+        self._transformed.add(delivery_tag)
+        self.settle_upstream()
+
+    def on_delivery_confirmation(self, method_frame):
+        """Invoked by pika when RabbitMQ confirms or rejects published outputs,
+        possibly several at once with the multiple flag. Confirmations of
+        messages republished by the retry policy go to Receiver.
+
+        :param pika.frame.Method method_frame: Basic.Ack or Basic.Nack frame
+
+        """
+        Receiver.on_delivery_confirmation(self, method_frame)
+        rejected = method_frame.method.NAME.split('.')[1].lower() == 'nack'
+        publish_number = method_frame.method.delivery_tag
+        if method_frame.method.multiple:
+            confirmed = []
+            while self._outputs and next(iter(self._outputs)) <= publish_number:
+                confirmed.append(self._outputs.popitem(last=False)[1])
+        else:
+            confirmed = [self._outputs.pop(publish_number, None)]
+        for delivery_tag in confirmed:
+            if delivery_tag is None or delivery_tag not in self._pending_outputs:
+                continue
+            self._pending_outputs[delivery_tag] -= 1
+            if rejected:
+                self._LOGGER.error('Output of message %s was rejected', delivery_tag)
+                self._rejected.add(delivery_tag)
+        self.settle_upstream()
+
+    def settle_upstream(self):
+        """Acknowledge the oldest upstream messages whose transform returned
+        and whose outputs are all confirmed, add their message ids to the
+        dedup cache and record their stream offsets. Messages with a rejected
+        output are rejected on their own.
+
+        """
+        completed = []
+        while self._upstream_order:
+            delivery_tag = self._upstream_order[0]
+            if (delivery_tag not in self._transformed or
+                    self._pending_outputs[delivery_tag]):
+                break
+            self._upstream_order.popleft()
+            self._transformed.discard(delivery_tag)
+            del self._pending_outputs[delivery_tag]
+            properties = self._upstream_properties.pop(delivery_tag)
+            if delivery_tag in self._rejected:
+                self._rejected.discard(delivery_tag)
+                self.acknowledge_upstream(completed)
+                completed = []
+                self.reject_upstream(delivery_tag)
+            else:
+                if self.dedup_cache is not None and properties.message_id:
+                    self.dedup_cache.add(properties.message_id)
+                completed.append(delivery_tag)
+            self.record_stream_offset(properties)
+        self.acknowledge_upstream(completed)
+
+    def acknowledge_upstream(self, delivery_tags):
+        """Acknowledge a run of completed upstream messages. A multiple-ack
+        also acknowledges every lower delivery tag, so it is only used if the
+        run is contiguous and no unsettled message precedes it.
+
+        :param list delivery_tags: The delivery tags in ascending order
+
+        """
+        if not delivery_tags:
+            return
+        last = delivery_tags[-1]
+        if (last - delivery_tags[0] + 1 == len(delivery_tags) and
+                not any(delivery_tag < last for delivery_tag in self._unsettled)):
+            self._LOGGER.debug('Acknowledging messages up to %s', last)
+            self._channel.basic_ack(last, multiple=True)
+            return
+        for delivery_tag in delivery_tags:
+            self._channel.basic_ack(delivery_tag)
+
+    def reject_upstream(self, delivery_tag):
+        """Reject an upstream message one of whose outputs was rejected.
+        It is requeued after requeue_delay seconds if requeue_on_nack is set.
+
+        :param int delivery_tag: The delivery tag of the upstream message
+
+        """
+        if not (self.requeue_on_nack and self.requeue_delay):
+            self._channel.basic_nack(delivery_tag, requeue=self.requeue_on_nack)
+            return
+        self._unsettled.add(delivery_tag)
+        self._connection.add_timeout(self.requeue_delay, functools.partial(
+            self.requeue_upstream, self._channel, delivery_tag))
+
+    def requeue_upstream(self, channel, delivery_tag):
+        """Invoked by the IOLoop timer set by reject_upstream. Requeues the
+        upstream message unless its channel has been closed meanwhile, which
+        requeued it already.
+
+        :param pika.channel.Channel channel: The channel the message was
+                delivered on
+        :param int delivery_tag: The delivery tag of the upstream message
+
+        """
+        if channel is not self._channel or not channel.is_open:
+            return
+        self._unsettled.discard(delivery_tag)
+        self._channel.basic_nack(delivery_tag, requeue=True)
+
+    def inflight_usage(self):
+        """Return a dictionary with the number of upstream messages in
+        progress (upstream) and of unconfirmed outputs (outputs).
+
+        """
+        return {'upstream': len(self._upstream_order), 'outputs': len(self._outputs)}
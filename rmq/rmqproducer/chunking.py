@@ -0,0 +1,33 @@
+TRANSFER_ID_HEADER = 'x-transfer-id'
+CHUNK_SEQ_HEADER = 'x-chunk-seq'
+CHUNK_LAST_HEADER = 'x-chunk-last'
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+
+def iter_chunks(stream, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Split a payload into chunks, yielding (sequence_number, chunk, last)
+    tuples. Sequence numbers start at 0 and the last chunk has last set to
+    True. An empty payload yields a single empty last chunk.
+
+    :param stream: A file-like object opened in binary mode, which is read
+            chunk_size bytes at a time, or an iterator of byte strings, whose
+            items are used as the chunks
+    :param int chunk_size: Number of bytes per chunk when reading a file-like
+            object. It's default value is 256 KiB
+
+    """
+    if hasattr(stream, 'read'):
+        pieces = iter(lambda: stream.read(chunk_size), b'')
+    else:
+        pieces = (piece for piece in stream if piece)
+    sequence_number = 0
+    previous = next(pieces, None)
+    if previous is None:
+        yield 0, b'', True
+        return
+    for piece in pieces:
+        yield sequence_number, previous, False
+        sequence_number += 1
+        previous = piece
+    yield sequence_number, previous, True
@@ -0,0 +1,82 @@
+from collections import deque
+
+
+class PriorityLanes(object):
+    """Named in-process message queues drained with smooth weighted round
+    robin scheduling.
+
+    Every lane has a weight. Among the lanes that have messages waiting, a
+    lane with weight 10 is picked ten times as often as a lane with weight 1,
+    and the picks are interleaved rather than sent in bursts. Messages inside
+    a lane keep their FIFO order.
+
+    """
+
+    def __init__(self, lanes):
+        """
+        :param dict lanes: Mapping of lane name to its configuration, either
+                the weight as an int or a dictionary with the keys weight and
+                (optionally) priority, the AMQP priority property given to the
+                messages of the lane e.g.
+                {'critical': {'weight': 10, 'priority': 9}, 'bulk': 1}
+
+        """
+        self._queues = {}
+        self._weights = {}
+        self._priorities = {}
+        self._current = {}
+        for name, config in lanes.items():
+            if not isinstance(config, dict):
+                config = {'weight': config}
+            weight = config.get('weight', 1)
+            if weight <= 0:
+                raise ValueError('Weight of lane %s must be positive' % name)
+            self._queues[name] = deque()
+            self._weights[name] = weight
+            self._priorities[name] = config.get('priority')
+            self._current[name] = 0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def lane_sizes(self):
+        """Return a dictionary with the number of messages waiting per lane."""
+        return dict((name, len(queue)) for name, queue in self._queues.items())
+
+    def priority(self, lane):
+        """Return the AMQP priority configured for the lane, or None."""
+        return self._priorities[lane]
+
+    def put(self, lane, item):
+        """Append an item to the lane.
+
+        :param str lane: Name of the lane
+        :param item: The item to be queued
+
+        """
+        if lane not in self._queues:
+            raise KeyError('Unknown lane %s' % lane)
+        self._queues[lane].append(item)
+
+    def get(self):
+        """Remove and return the next (lane, item) pair according to the lane
+        weights. Raises IndexError if every lane is empty.
+
+        """
+        total_weight = 0
+        chosen = None
+        for name, queue in self._queues.items():
+            if not queue:
+                continue
+            weight = self._weights[name]
+            self._current[name] += weight
+            total_weight += weight
+            if chosen is None or self._current[name] > self._current[chosen]:
+                chosen = name
+        if chosen is None:
+            raise IndexError('All lanes are empty')
+        self._current[chosen] -= total_weight
+        if len(self._queues[chosen]) == 1:
+            # an emptied lane starts from scratch when it gets busy again
+            self._current[chosen] = 0
+        return chosen, self._queues[chosen].popleft()
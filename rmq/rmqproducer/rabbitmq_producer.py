@@ -1,9 +1,13 @@
 import sys
 import pika
 import signal
+import uuid
 import logging
 from random import randint
 
+from rmq.rmqproducer import chunking
+from rmq.rmqproducer.lanes import PriorityLanes
+
 class Publisher(object):
     """This is a safe and robust publisher that will handle unexpected interactions
     with RabbitMQ such as channel and connection closures.
@@ -14,7 +18,12 @@ class Publisher(object):
     socket timeouts.
 
     It uses delivery confirmations and keeps track of messages that have been
-    sent and if they've been confirmed by RabbitMQ.
+    sent and if they've been confirmed by RabbitMQ. The number and total size
+    of messages waiting for a confirmation are bounded; publish_message()
+    blocks until there is room again. Without delivery confirmations no state
+    is kept per message. Every message is stamped
+    with a message_id which is kept when the message is republished after a
+    reconnection, so that consumers can recognise duplicates.
 
     """
 
@@ -26,7 +35,8 @@ class Publisher(object):
 
         The optional arguments are:
         exchange_type, exchange_durable, exchange_auto_delete, exchange_internal,
-        delivery_confirmation, nack_callback, safe_stop
+        delivery_confirmation, nack_callback, safe_stop, reconnect_time, lanes,
+        max_inflight_messages, max_inflight_bytes
 
         :param str amqp_url: The AMQP url to connect with
         :param str exchange: Name of exchange
@@ -52,12 +62,27 @@ class Publisher(object):
         :param reconnect_time: The number of seconds after which connection will 
                 automatically restart if it accidently stops. Its default value 
                 is 5 seconds.
+        :param dict lanes: Named priority lanes for queue_message(). It maps
+                the lane name to its weight, or to a dictionary with the keys
+                weight and priority (the AMQP priority property set on the
+                messages of that lane), e.g.
+                {'critical': {'weight': 10, 'priority': 9}, 'bulk': 1}.
+                It's default value is None i.e. no lanes
+        :param int max_inflight_messages: Maximum number of published messages
+                waiting for a delivery confirmation. publish_message() returns
+                only once fewer messages than this are unconfirmed. It's default
+                value is 1 i.e. every message is confirmed before the next one
+                is published
+        :param int max_inflight_bytes: Maximum total size of the published
+                messages waiting for a delivery confirmation. It's default value
+                is None i.e. unbounded
 
         """
         self._connection = None
         self._channel = None
         self._messages = {}
         self._message_number = 0
+        self._inflight_bytes = 0
         self._channel_closing = False
         self._connection_closing = False
         self._LOGGER = logging.getLogger(__name__)
@@ -80,6 +105,10 @@ class Publisher(object):
         self.nack_callback = kwargs.get('nack_callback')
         self.safe_stop = kwargs.get('safe_stop', True)
         self.reconnect_time = kwargs.get('reconnect_time', 5)
+        self.max_inflight_messages = kwargs.get('max_inflight_messages', 1)
+        self.max_inflight_bytes = kwargs.get('max_inflight_bytes')
+        lanes = kwargs.get('lanes')
+        self._lanes = PriorityLanes(lanes) if lanes else None
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
@@ -175,7 +204,7 @@ class Publisher(object):
             self._LOGGER.warn("Publishing Messages left on reconnection")
             for message in unpublished_messages.values():
                 self.publish_message(
-                    message['message'], message['routing_key'])
+                    message['message'], message['routing_key'], message['properties'])
 
     def reset_messages(self):
         """This method resets message dictionary and message counter. Since 
@@ -186,6 +215,7 @@ class Publisher(object):
         """
         self._messages = {}
         self._message_number = 0
+        self._inflight_bytes = 0
 
     def open_channel(self):
         """This method will open a new channel with RabbitMQ by issuing the
@@ -259,7 +289,7 @@ class Publisher(object):
                 "Publishing Messages left on channel reopening")
             for message in unpublished_messages.values():
                 self.publish_message(
-                    message['message'], message['routing_key'])
+                    message['message'], message['routing_key'], message['properties'])
         self._LOGGER.warn("reopening channel successful")
 
     def setup_exchange(self, exchange_name):
@@ -322,54 +352,196 @@ class Publisher(object):
         we expect a delivery confirmation of from the list used to keep track
         of messages that are pending confirmation.
 
+        When several messages are unconfirmed, RabbitMQ may confirm all of them
+        up to the delivery tag at once by setting the multiple flag.
+
         :param pika.frame.Method method_frame: Basic.Ack or Basic.Nack frame
 
         """
         confirmation_type = method_frame.method.NAME.split('.')[1].lower()
-        message_num = method_frame.method.delivery_tag
-        if confirmation_type == 'ack':
-            self._LOGGER.info('Message %i published successfully',
-                              message_num)
-            self._LOGGER.debug('The message published: %s',
-                               self._messages[message_num]['message'])
-        if confirmation_type == 'nack':
-            self._LOGGER.error('The message %i failed to publish: %s',
-                               message_num, self._messages[message_num]['message'])
-            if self.nack_callback:
-                self.nack_callback(self._messages[message_num]['message'])
-        del self._messages[message_num]
+        delivery_tag = method_frame.method.delivery_tag
+        if method_frame.method.multiple:
+            message_numbers = sorted(number for number in self._messages
+                                     if number <= delivery_tag)
+        else:
+            message_numbers = [delivery_tag]
+        for message_num in message_numbers:
+            message = self._messages.pop(message_num, None)
+            if message is None:
+                continue
+            self._inflight_bytes -= message['size']
+            if confirmation_type == 'ack':
+                self._LOGGER.info('Message %i published successfully',
+                                  message_num)
+                self._LOGGER.debug('The message published: %s', message['message'])
+            if confirmation_type == 'nack':
+                self._LOGGER.error('The message %i failed to publish: %s',
+                                   message_num, message['message'])
+                if self.nack_callback:
+                    self.nack_callback(message['message'])
         self._connection.ioloop.stop()
 
-    def publish_message(self, message, routing_key):
+    def inflight_full(self):
+        """Check if the number or the total size of unconfirmed messages has
+        reached its limit.
+
+        """
+        if self.max_inflight_messages and len(self._messages) >= self.max_inflight_messages:
+            return True
+        return bool(self.max_inflight_bytes and
+                    self._inflight_bytes >= self.max_inflight_bytes)
+
+    def inflight_usage(self):
+        """Return a dictionary with the number (messages) and the total size
+        in bytes (bytes) of the published messages waiting for a delivery
+        confirmation. Both stay 0 without delivery confirmations.
+
+        """
+        return {'messages': len(self._messages), 'bytes': self._inflight_bytes}
+
+    def wait_for_confirmations(self):
+        """Block until every published message has been confirmed by
+        RabbitMQ.
+
+        """
+        while self._messages:
+            self._connection.ioloop.start()
+
+    def publish_message(self, message, routing_key, properties=None):
         """This method publish a message to RabbitMQ, appending a list of 
         deliveries with the message number that was sent. This list will be 
         used to check for delivery confirmations in the on_delivery_confirmations 
         method.
 
+        Unless properties already carry one, a unique message_id is generated
+        for the message. The same message_id is used if the message has to be
+        published again after a reconnection.
+
         :param str message: The message to be published
         :param str routing_key: The routing key for the message to be published
+        :param dict properties: Extra pika.BasicProperties fields for the
+                message e.g. headers, message_id, priority. Messages are always
+                published persistent (delivery_mode 2) unless overridden here
 
         """
+        properties = dict(properties or {})
+        properties.setdefault('delivery_mode', 2)  # make message persistent
+        if not properties.get('message_id'):
+            properties['message_id'] = uuid.uuid4().hex
+
         if not (self._channel and self._channel.is_open and self._connection and self._connection.is_open):
             self._LOGGER.warn("channel or connection not available... reconnecting")
             self.reconnect()
 
         if self._channel.is_open:
-            self._channel.basic_publish(self.exchange, routing_key, message, properties=pika.BasicProperties(
-                delivery_mode=2,  # make message persistent
-            ))
+            self._channel.basic_publish(self.exchange, routing_key, message,
+                                        properties=pika.BasicProperties(**properties))
         else:
             self._LOGGER.error("Channel not open. Message %s couldn't be published. "
                                "Will try to publish message again if channel reopens", message)
             return
+        if not self.delivery_confirmation:
+            # nothing will ever confirm the message, so there is nothing to track
+            return
         self._message_number += 1
+        size = len(message)
+        if not isinstance(message, bytes):
+            # text goes over the wire UTF-8 encoded
+            size = len(message.encode('utf-8'))
         self._messages[self._message_number] = {
-            'message': message, 'routing_key': routing_key}
+            'message': message, 'routing_key': routing_key, 'properties': properties,
+            'size': size}
+        self._inflight_bytes += size
         self._LOGGER.debug('Publishing message # %i', self._message_number)
 
-        if self.delivery_confirmation:
+        # backpressure: wait for confirmations until there is room for the next message
+        while self._messages and self.inflight_full():
             self._connection.ioloop.start()
 
+    def publish_stream(self, stream, routing_key, chunk_size=chunking.DEFAULT_CHUNK_SIZE,
+                       properties=None):
+        """Publish a large payload as a sequence of chunk messages so that
+        neither side has to hold the whole payload in memory. Every chunk
+        carries the transfer id, its sequence number and whether it is the
+        last one in its headers. A Receiver with a transfer_callback or
+        chunk_callback puts them back together.
+
+        With delivery confirmations every chunk is confirmed before the next
+        one is read from the stream.
+
+        :param stream: A file-like object opened in binary mode or an iterator
+                of byte strings
+        :param str routing_key: The routing key for the chunks
+        :param int chunk_size: Number of bytes per chunk when reading a
+                file-like object. It's default value is 256 KiB
+        :param dict properties: Extra pika.BasicProperties fields, applied to
+                every chunk
+        :rtype: str
+        :return: The transfer id
+
+        """
+        transfer_id = uuid.uuid4().hex
+        for sequence_number, chunk, last in chunking.iter_chunks(stream, chunk_size):
+            chunk_properties = dict(properties or {})
+            headers = dict(chunk_properties.get('headers') or {})
+            headers[chunking.TRANSFER_ID_HEADER] = transfer_id
+            headers[chunking.CHUNK_SEQ_HEADER] = sequence_number
+            headers[chunking.CHUNK_LAST_HEADER] = last
+            chunk_properties['headers'] = headers
+            chunk_properties['message_id'] = '%s.%d' % (transfer_id, sequence_number)
+            self.publish_message(chunk, routing_key, chunk_properties)
+        self._LOGGER.debug('Published transfer %s in %d chunks',
+                           transfer_id, sequence_number + 1)
+        return transfer_id
+
+    def queue_message(self, message, routing_key, lane, properties=None):
+        """Put a message in one of the priority lanes instead of publishing
+        it right away. Queued messages are published by flush_lanes().
+
+        :param str message: The message to be published
+        :param str routing_key: The routing key for the message to be published
+        :param str lane: Name of a lane given in the lanes argument
+        :param dict properties: Extra pika.BasicProperties fields for the message
+
+        """
+        if self._lanes is None:
+            raise ValueError('Publisher was created without lanes')
+        self._lanes.put(lane, (message, routing_key, properties))
+
+    def flush_lanes(self, max_messages=None):
+        """Publish the messages waiting in the priority lanes, choosing the
+        lane of every next message by weighted round robin. Messages of lanes
+        with a priority get it as their AMQP priority property unless they
+        were queued with one.
+
+        Calling this often with a small max_messages keeps a backlog of a low
+        weight lane from delaying messages queued later in a heavier lane.
+
+        :param int max_messages: Publish at most this many messages. It's
+                default value is None i.e. until all lanes are empty
+        :rtype: int
+        :return: The number of messages published
+
+        """
+        if self._lanes is None:
+            return 0
+        published = 0
+        while self._lanes and (max_messages is None or published < max_messages):
+            lane, (message, routing_key, properties) = self._lanes.get()
+            priority = self._lanes.priority(lane)
+            if priority is not None:
+                properties = dict(properties or {})
+                properties.setdefault('priority', priority)
+            self.publish_message(message, routing_key, properties)
+            published += 1
+        return published
+
+    def lane_sizes(self):
+        """Return a dictionary with the number of messages waiting per lane."""
+        if self._lanes is None:
+            return {}
+        return self._lanes.lane_sizes()
+
     def close_channel(self):
         """Invoke this command to close the channel with RabbitMQ by sending
         the Channel.Close RPC command.
@@ -409,10 +581,14 @@ class Publisher(object):
         be sent back to the pool and reused by some other user saving the cost 
         of creating a new connection
 
+        Messages still waiting for a delivery confirmation are confirmed
+        before the channel is closed.
+
         """
+        if self._channel and self._channel.is_open:
+            self.wait_for_confirmations()
         self._channel_closing = True
         self.close_channel()
-        self.close_connection()
         self._connection.ioloop.start()
 
     def stop_connection(self):
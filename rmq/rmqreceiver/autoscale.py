@@ -0,0 +1,172 @@
+import math
+import time
+import logging
+
+
+class BacklogMonitor(object):
+    """Estimates how fast a queue fills up and drains, and how many
+    consumers it needs to keep its backlog drainable within a target time.
+
+    Receiver feeds it periodically with the message and consumer counts of a
+    passive Queue.Declare and with the number of messages it has processed
+    itself. The local processing rate is taken as the rate of every consumer
+    of the queue. The arrival rate is the growth of the backlog plus the
+    estimated drain rate. Rates are smoothed with an exponentially weighted
+    moving average.
+
+    The capacity of a consumer (or, with a process pool, of a worker process)
+    is only measured while the consumers are saturated, i.e. while the
+    backlog stays above zero; otherwise they process what arrives and their
+    rate says nothing about what they could do. The needed capacity is
+    arrival_rate + backlog / target_drain_time, so once the backlog is gone
+    the consumers shrink towards arrival_rate / capacity. When the number of
+    consumers needed differs from the current one, scale_hook is called, or
+    the process pool is resized to handle its share of the queue.
+
+    """
+
+    def __init__(self, interval=10, target_drain_time=60, scale_hook=None,
+                 process_pool=None, min_consumers=1, max_consumers=None,
+                 smoothing=0.3):
+        """
+        :param float interval: Seconds between two polls of the queue. It's
+                default value is 10
+        :param float target_drain_time: Seconds within which the backlog should
+                be drained. It's default value is 60
+        :param method scale_hook: The method to callback with the signature
+                scale_hook(desired, stats) when the number of consumers should
+                change, where stats is the dictionary returned by stats(). It's
+                default value is None
+        :param process_pool: A rmq.rmqreceiver.process_pool.SharedMemoryPool to
+                grow and shrink instead of counting consumers. It's default value
+                is None
+        :param int min_consumers: Lower bound of the desired consumers (or
+                worker processes). It's default value is 1
+        :param int max_consumers: Upper bound of the desired consumers (or
+                worker processes). It's default value is None i.e. unbounded
+        :param float smoothing: Weight of the newest sample in the moving
+                averages, between 0 and 1. It's default value is 0.3
+
+        """
+        self._LOGGER = logging.getLogger(__name__)
+        self.interval = interval
+        self.target_drain_time = target_drain_time
+        self.scale_hook = scale_hook
+        self.process_pool = process_pool
+        self.min_consumers = min_consumers
+        self.max_consumers = max_consumers
+        self.smoothing = smoothing
+        self.backlog = None
+        self.consumers = None
+        self.arrival_rate = None
+        self.drain_rate = None
+        # messages per second a consumer or worker process can handle
+        self.unit_rate = None
+        self.queue_consumers = None
+        self.desired = None
+        self._last_sample = None
+
+    def _average(self, previous, sample):
+        if previous is None:
+            return sample
+        return self.smoothing * sample + (1 - self.smoothing) * previous
+
+    def update(self, message_count, consumer_count, processed, now=None):
+        """Add a sample and rescale if needed.
+
+        :param int message_count: Messages ready in the queue
+        :param int consumer_count: Consumers of the queue
+        :param int processed: Total number of messages processed by this
+                Receiver so far
+        :param float now: Time of the sample. It's default value is the
+                current time
+
+        """
+        if now is None:
+            now = time.time()
+        self.backlog = message_count
+        self.queue_consumers = consumer_count
+        if self.process_pool is not None:
+            self.consumers = self.process_pool.processes
+        else:
+            self.consumers = consumer_count
+        if self._last_sample is not None:
+            last_time, last_count, last_processed = self._last_sample
+            elapsed = now - last_time
+            if elapsed > 0:
+                local_rate = (processed - last_processed) / float(elapsed)
+                # this Receiver is one of the consumers, with a process pool
+                # it splits its share among the worker processes
+                drain_rate = local_rate * consumer_count
+                unit_rate = local_rate
+                if self.process_pool is not None:
+                    unit_rate = local_rate / max(self.consumers, 1)
+                arrival_rate = max((message_count - last_count) / float(elapsed) + drain_rate, 0.0)
+                if message_count and last_count:
+                    self.unit_rate = self._average(self.unit_rate, unit_rate)
+                elif self.unit_rate is None or unit_rate > self.unit_rate:
+                    # not saturated, but the capacity is at least the rate
+                    self.unit_rate = unit_rate
+                self.drain_rate = self._average(self.drain_rate, drain_rate)
+                self.arrival_rate = self._average(self.arrival_rate, arrival_rate)
+                self.rescale()
+        self._last_sample = (now, message_count, processed)
+
+    def drain_time(self):
+        """Return the estimated seconds until the backlog is drained, None if
+        unknown and infinity if the backlog grows.
+
+        """
+        if self.drain_rate is None:
+            return None
+        net_rate = self.drain_rate - self.arrival_rate
+        if self.backlog == 0:
+            return 0.0
+        if net_rate <= 0:
+            return float('inf')
+        return self.backlog / net_rate
+
+    def desired_consumers(self):
+        """Return the number of consumers (or worker processes of the pool)
+        needed to drain the backlog within target_drain_time while keeping up
+        with arrivals, or the current number if the capacity of a consumer
+        isn't known yet.
+
+        """
+        if not self.unit_rate:
+            # nothing was processed, so there is no rate to scale by
+            desired = self.consumers
+        else:
+            needed_rate = self.arrival_rate + self.backlog / float(self.target_drain_time)
+            if self.process_pool is not None:
+                # the other consumers of the queue take their share
+                needed_rate /= max(self.queue_consumers, 1)
+            desired = int(math.ceil(needed_rate / self.unit_rate))
+        desired = max(desired, self.min_consumers)
+        if self.max_consumers is not None:
+            desired = min(desired, self.max_consumers)
+        return desired
+
+    def rescale(self):
+        """Resize the process pool or call the scale hook if the desired
+        number of consumers differs from the current one.
+
+        """
+        self.desired = self.desired_consumers()
+        if self.desired == self.consumers:
+            return
+        self._LOGGER.info('Scaling from %s to %s consumers: %s',
+                          self.consumers, self.desired, self.stats())
+        if self.process_pool is not None:
+            self.process_pool.resize(self.desired)
+        if self.scale_hook is not None:
+            self.scale_hook(self.desired, self.stats())
+
+    def stats(self):
+        """Return the latest estimates as a dictionary with the keys backlog,
+        consumers, desired, arrival_rate, drain_rate and drain_time.
+
+        """
+        return {'backlog': self.backlog, 'consumers': self.consumers,
+                'desired': self.desired, 'arrival_rate': self.arrival_rate,
+                'drain_rate': self.drain_rate, 'drain_time': self.drain_time()}
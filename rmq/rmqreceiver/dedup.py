@@ -0,0 +1,249 @@
+import os
+import mmap
+import time
+import struct
+import hashlib
+from collections import OrderedDict
+
+
+class _CacheStats(object):
+    """Hit/miss counters shared by the message id caches.
+
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        """Return the fraction of lookups which found a duplicate. It is 0.0
+        when no lookup has been made yet.
+
+        """
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats(self):
+        """Return the cache metrics as a dictionary with the keys hits, misses,
+        hit_rate and size.
+
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate(), 'size': len(self)}
+
+
+class MessageIdCache(_CacheStats):
+    """In memory set of recently processed message ids, bounded both by the
+    number of entries (least recently used ids are evicted first) and
+    optionally by age. Seeing an id again counts as a use and restarts its
+    ttl, so entries are always ordered by their last use and both bounds
+    evict from the same end.
+
+    Receiver uses it to skip messages which were redelivered or republished
+    after they had already been handled.
+
+    """
+
+    def __init__(self, max_size=100000, ttl=None):
+        """
+        :param int max_size: Maximum number of message ids to remember. It's
+                default value is 100000
+        :param float ttl: Number of seconds after which a message id which
+                wasn't added or seen again is forgotten. It's default value is
+                None i.e. ids are only evicted when the cache is full
+
+        """
+        super(MessageIdCache, self).__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def seen(self, message_id):
+        """Return True if the message id was added before and hasn't expired
+        yet. Every call is counted as a hit or a miss.
+
+        :param str message_id: The message_id property of the message
+
+        """
+        now = time.time()
+        used_at = self._entries.pop(message_id, None)
+        if used_at is not None and not self._expired(used_at, now):
+            # re-inserting moves the id to the most recently used end
+            self._entries[message_id] = now
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, message_id):
+        """Remember the message id as processed.
+
+        :param str message_id: The message_id property of the message
+
+        """
+        now = time.time()
+        self._entries.pop(message_id, None)
+        self._entries[message_id] = now
+        self._evict(now)
+
+    def _expired(self, used_at, now):
+        return self.ttl is not None and now - used_at >= self.ttl
+
+    def _evict(self, now):
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        if self.ttl is None:
+            return
+        while self._entries:
+            oldest = next(iter(self._entries))
+            if not self._expired(self._entries[oldest], now):
+                break
+            del self._entries[oldest]
+
+    def close(self):
+        """Nothing to release for the in memory cache."""
+        pass
+
+
+class MmapMessageIdCache(_CacheStats):
+    """Message id cache stored in a fixed size memory mapped file, so that the
+    processed ids survive a restart of the consumer process.
+
+    The file is an open addressing hash table. Every slot holds an 8 byte
+    fingerprint of the message id and the time it was last added or seen. A
+    lookup probes at most `probe` consecutive slots; when all of them are
+    taken, the oldest one is overwritten. The number of occupied slots is kept
+    in the file header.
+
+    """
+
+    _MAGIC = b'RMQD'
+    _HEADER = struct.Struct('>4sQQ')
+    _SLOT = struct.Struct('>Qd')
+
+    def __init__(self, path, slots=1 << 20, ttl=None, probe=8):
+        """
+        :param str path: Path of the file backing the cache. It is created if
+                it doesn't exist and reinitialised if it was created with a
+                different number of slots
+        :param int slots: Number of slots in the table. The file takes 16
+                bytes per slot. It's default value is 1048576
+        :param float ttl: Number of seconds after which a message id which
+                wasn't added or seen again is forgotten. It's default value is
+                None
+        :param int probe: Number of slots checked per lookup. It's default
+                value is 8
+
+        """
+        super(MmapMessageIdCache, self).__init__()
+        self.path = path
+        self.slots = slots
+        self.ttl = ttl
+        self.probe = min(probe, slots)
+        size = self._HEADER.size + slots * self._SLOT.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, stored_slots, occupied = self._HEADER.unpack_from(self._map, 0)
+        self._occupied = occupied
+        if fresh or magic != self._MAGIC or stored_slots != slots:
+            self._map[:] = b'\x00' * size
+            self._occupied = 0
+            self._HEADER.pack_into(self._map, 0, self._MAGIC, slots, 0)
+
+    def __len__(self):
+        """Return the number of occupied slots. Expired ids count until their
+        slot is reused.
+
+        """
+        return self._occupied
+
+    def _fingerprint(self, message_id):
+        if not isinstance(message_id, bytes):
+            message_id = message_id.encode('utf-8')
+        key = struct.unpack('>Q', hashlib.md5(message_id).digest()[:8])[0]
+        # 0 marks an empty slot
+        return key or 1
+
+    def _offset(self, index):
+        return self._HEADER.size + index * self._SLOT.size
+
+    def _read(self, index):
+        return self._SLOT.unpack_from(self._map, self._offset(index))
+
+    def _write(self, index, key, used_at):
+        self._SLOT.pack_into(self._map, self._offset(index), key, used_at)
+
+    def _expired(self, used_at, now):
+        return self.ttl is not None and now - used_at >= self.ttl
+
+    def _probe_indexes(self, key):
+        start = key % self.slots
+        return [(start + step) % self.slots for step in range(self.probe)]
+
+    def seen(self, message_id):
+        """Return True if the message id was added before and hasn't expired
+        yet. Every call is counted as a hit or a miss.
+
+        :param str message_id: The message_id property of the message
+
+        """
+        key = self._fingerprint(message_id)
+        now = time.time()
+        for index in self._probe_indexes(key):
+            slot_key, used_at = self._read(index)
+            if slot_key == key and not self._expired(used_at, now):
+                self._write(index, key, now)
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def add(self, message_id):
+        """Remember the message id as processed.
+
+        :param str message_id: The message_id property of the message
+
+        """
+        key = self._fingerprint(message_id)
+        now = time.time()
+        match = free = oldest = None
+        oldest_used_at = None
+        for index in self._probe_indexes(key):
+            slot_key, used_at = self._read(index)
+            if slot_key == key:
+                match = index
+                break
+            if not slot_key:
+                # slots are never emptied again, so the id can't be further
+                # down the chain
+                if free is None:
+                    free = index
+                break
+            if free is None and self._expired(used_at, now):
+                free = index
+            if oldest is None or used_at < oldest_used_at:
+                oldest, oldest_used_at = index, used_at
+        victim = next(index for index in (match, free, oldest) if index is not None)
+        victim_empty = match is None and not self._read(victim)[0]
+        self._write(victim, key, now)
+        if victim_empty:
+            self._occupied += 1
+            self._HEADER.pack_into(self._map, 0, self._MAGIC, self.slots,
+                                   self._occupied)
+
+    def close(self):
+        """Flush the table to disk and unmap the file."""
+        self._map.flush()
+        self._map.close()
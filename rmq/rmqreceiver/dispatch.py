@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'handlers')
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+
+class TopicDispatcher(object):
+    """Registry of handlers keyed by AMQP topic patterns.
+
+    Patterns are dot separated words where '*' matches exactly one word and
+    '#' matches zero or more words, as in topic exchange bindings. They are
+    compiled into a trie of words, so matching a routing key only walks the
+    branches its words can take instead of testing every pattern, and the
+    result for every routing key is kept in an LRU cache.
+
+    """
+
+    def __init__(self, cache_size=10000):
+        """
+        :param int cache_size: Number of routing keys whose matching handlers
+                are cached, 0 disabling the cache. It's default value is 10000
+
+        """
+        self.cache_size = cache_size
+        self._root = _TrieNode()
+        self._patterns = []
+        self._registrations = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def patterns(self):
+        """Return the registered patterns in registration order, without
+        duplicates.
+
+        """
+        return list(self._patterns)
+
+    def add(self, pattern, handler):
+        """Register a handler for the routing keys matching the pattern.
+
+        :param str pattern: AMQP topic pattern e.g. 'order.*.created' or 'audit.#'
+        :param method handler: The handler to be returned by match()
+
+        """
+        node = self._root
+        for word in pattern.split('.'):
+            node = node.children.setdefault(word, _TrieNode())
+        node.handlers.append((self._registrations, handler))
+        self._registrations += 1
+        if pattern not in self._patterns:
+            self._patterns.append(pattern)
+        self._cache.clear()
+
+    def match(self, routing_key):
+        """Return the tuple of handlers whose pattern matches the routing key,
+        in registration order. A handler registered under several matching
+        patterns is returned once.
+
+        :param str routing_key: The routing key of the message
+
+        """
+        handlers = self._cache.pop(routing_key, None)
+        if handlers is None:
+            matches = {}
+            self._match(self._root, routing_key.split('.'), 0, matches)
+            handlers = []
+            for sequence, handler in sorted(matches.values(), key=lambda match: match[0]):
+                if handler not in handlers:
+                    handlers.append(handler)
+            handlers = tuple(handlers)
+            if self.cache_size <= 0:
+                return handlers
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[routing_key] = handlers
+        return handlers
+
+    def _match(self, node, words, index, matches):
+        if index == len(words):
+            for registration in node.handlers:
+                matches[registration[0]] = registration
+        else:
+            child = node.children.get(words[index])
+            if child is not None:
+                self._match(child, words, index + 1, matches)
+            child = node.children.get('*')
+            if child is not None:
+                self._match(child, words, index + 1, matches)
+        child = node.children.get('#')
+        if child is not None:
+            # '#' swallows any number of the remaining words, including none
+            for next_index in range(index, len(words) + 1):
+                self._match(child, words, next_index, matches)
@@ -0,0 +1,64 @@
+import os
+import time
+
+
+class OffsetCheckpoint(object):
+    """Keeps the offset of the last processed message of a stream queue in a
+    local file, so that a restarted consumer continues where it left off.
+
+    The offset is written at most once per interval and atomically, by
+    writing a temporary file and renaming it over the checkpoint file.
+
+    """
+
+    def __init__(self, path, interval=5):
+        """
+        :param str path: Path of the checkpoint file
+        :param float interval: Minimum number of seconds between two writes of
+                the checkpoint file. It's default value is 5
+
+        """
+        self.path = path
+        self.interval = interval
+        self.offset = self.load()
+        self._saved_offset = self.offset
+        self._saved_at = time.time()
+
+    def load(self):
+        """Return the offset stored in the checkpoint file, or None if there
+        is no checkpoint yet.
+
+        """
+        try:
+            with open(self.path) as checkpoint_file:
+                return int(checkpoint_file.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def update(self, offset):
+        """Record the offset of a processed message, writing the checkpoint
+        file if the interval has passed since the last write.
+
+        :param int offset: The x-stream-offset of the message
+
+        """
+        self.offset = offset
+        if time.time() - self._saved_at >= self.interval:
+            self.save()
+
+    def save(self):
+        """Write the current offset to the checkpoint file, if it changed."""
+        self._saved_at = time.time()
+        if self.offset is None or self.offset == self._saved_offset:
+            return
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            checkpoint_file.write('%d\n' % self.offset)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(temporary_path, self.path)
+        self._saved_offset = self.offset
+
+    def close(self):
+        """Write the latest offset before the consumer stops."""
+        self.save()
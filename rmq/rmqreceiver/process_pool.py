@@ -0,0 +1,344 @@
+import ctypes
+import logging
+import multiprocessing
+from collections import deque
+
+# pika.adapters.select_connection READ event, for IOLoop.add_handler()
+_READ = 0x0001
+
+
+class WorkerError(Exception):
+    """Reported for a message whose handler raised an exception which couldn't
+    be sent back from the worker process, or whose worker process died.
+
+    """
+
+
+def _worker_main(handler, buffer, tasks, results):
+    """Loop of a worker process: take a task, call the handler with a view of
+    the body in shared memory and report back.
+
+    """
+    view = memoryview(buffer)
+    if hasattr(view, 'cast'):
+        view = view.cast('B')
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, offset, length, inline_body, basic_deliver, properties = task
+        if offset is None:
+            body = inline_body
+        else:
+            body = view[offset:offset + length]
+        try:
+            handler(basic_deliver, properties, body)
+        except Exception as error:
+            try:
+                results.send((task_id, error))
+            except Exception:
+                # the exception can't be pickled
+                results.send((task_id, WorkerError(repr(error))))
+        else:
+            results.send((task_id, None))
+
+
+class _Worker(object):
+
+    def __init__(self, process, tasks, results):
+        self.process = process
+        self.tasks = tasks
+        self.results = results
+        self.pending = set()
+        self.retiring = False
+
+
+class _Ring(object):
+    """Allocates variable length regions of a buffer in FIFO order. Regions
+    may be freed in any order; the space of a region is reused once every
+    region allocated before it has been freed too.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._head = 0
+        # [offset, length, freed] in allocation order
+        self._regions = deque()
+
+    def allocate(self, length):
+        """Return a region of the given length, or None if there is no
+        contiguous free space for it.
+
+        """
+        if not self._regions:
+            self._head = 0
+            offset = 0 if length <= self.size else None
+        else:
+            tail = self._regions[0][0]
+            if tail < self._head:
+                # free space at the end and, after wrapping, at the start
+                if self.size - self._head >= length:
+                    offset = self._head
+                elif tail >= length:
+                    offset = 0
+                else:
+                    offset = None
+            else:
+                offset = self._head if tail - self._head >= length else None
+        if offset is None:
+            return None
+        region = [offset, length, False]
+        self._regions.append(region)
+        self._head = offset + length
+        return region
+
+    def free(self, region):
+        region[2] = True
+        while self._regions and self._regions[0][2]:
+            self._regions.popleft()
+
+
+class SharedMemoryPool(object):
+    """Pool of worker processes for CPU heavy message handlers.
+
+    Message bodies are copied once into a ring buffer in shared memory and
+    the workers only receive the offset and length of the body, so bodies are
+    neither pickled nor copied again on their way to the workers. The space
+    of a body is recycled once a worker reports completion. Bodies larger
+    than the buffer, or arriving while the buffer is full, are sent pickled
+    instead.
+
+    Every worker has its own task queue and result pipe. A message goes to
+    the worker with the fewest messages in progress. A worker which dies
+    closes its pipe, so poll() notices it, reports its messages as failed
+    with WorkerError and starts a replacement.
+
+    The handler runs in a worker process with the signature
+    handler(method, properties, body), where body is a memoryview of the
+    shared memory which is only valid until the handler returns. Workers are
+    started with the forkserver start method where it is available, so that
+    workers started while the connection is open, i.e. replacements and the
+    ones added by resize(), don't inherit its socket. The handler then has to
+    be picklable, i.e. a module level function. With start_method='fork' any
+    callable works, but the pool should be created before Receiver.run().
+
+    """
+
+    def __init__(self, handler, processes=None, max_in_progress=None,
+                 buffer_size=32 * 1024 * 1024, requeue_on_error=False, start_method=None):
+        """
+        :param method handler: The method the workers call for every message
+        :param int processes: Number of worker processes. It's default value is
+                the number of CPUs
+        :param int max_in_progress: Number of messages in progress at a time,
+                used as prefetch count. It's default value is 4 per worker
+                process
+        :param int buffer_size: Size in bytes of the shared memory ring. It
+                should hold max_in_progress bodies of the usual size. It's
+                default value is 32 MiB
+        :param bool requeue_on_error: Requeue the messages whose handler raised
+                instead of rejecting them, when the Receiver has no retry
+                policy. They are redelivered right away, so a handler which
+                always fails on a message loops on it. It's default value is
+                False
+        :param str start_method: The multiprocessing start method of the
+                workers. It's default value is None i.e. 'forkserver' where
+                available, else the platform default
+
+        """
+        self._LOGGER = logging.getLogger(__name__)
+        self.handler = handler
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_in_progress = max_in_progress or self.processes * 4
+        self.buffer_size = buffer_size
+        self.requeue_on_error = requeue_on_error
+        self._context = multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            if (start_method is None and
+                    'forkserver' in multiprocessing.get_all_start_methods()):
+                start_method = 'forkserver'
+            self._context = multiprocessing.get_context(start_method)
+        self._buffer = self._context.RawArray(ctypes.c_char, buffer_size)
+        self._ring = _Ring(buffer_size)
+        # task id -> (worker, ring region, inline body, token)
+        self._pending = {}
+        self._task_id = 0
+        self._workers = []
+        self._ioloop = None
+        self._callback = None
+        self.start_workers(self.processes)
+
+    def start_workers(self, count):
+        """Start the given number of additional worker processes."""
+        for _ in range(count):
+            tasks = self._context.Queue()
+            results, worker_results = self._context.Pipe(duplex=False)
+            process = self._context.Process(
+                target=_worker_main,
+                args=(self.handler, self._buffer, tasks, worker_results))
+            process.daemon = True
+            process.start()
+            # only the worker holds the write end now, so its death shows up
+            # as the end of the pipe
+            worker_results.close()
+            worker = _Worker(process, tasks, results)
+            self._workers.append(worker)
+            if self._ioloop is not None:
+                self._watch(worker)
+
+    def attach(self, ioloop, callback):
+        """Call callback() from the IOLoop whenever a worker reports a
+        completion or dies, instead of polling on a timer.
+
+        :param ioloop: The IOLoop of the pika connection
+        :param method callback: The method which calls poll()
+
+        """
+        self._ioloop = ioloop
+        self._callback = callback
+        for worker in self._workers:
+            self._watch(worker)
+
+    def _watch(self, worker):
+        self._ioloop.add_handler(worker.results.fileno(),
+                                 lambda fd, events: self._callback(), _READ)
+
+    def _unwatch(self, worker):
+        if self._ioloop is not None:
+            self._ioloop.remove_handler(worker.results.fileno())
+
+    def resize(self, processes):
+        """Grow or shrink the pool to the given number of worker processes.
+        Leaving workers exit once they finished their tasks. max_in_progress
+        stays the same, so it bounds the useful number of workers.
+
+        :param int processes: The new number of worker processes
+
+        """
+        processes = max(processes, 1)
+        active = [worker for worker in self._workers if not worker.retiring]
+        if processes > len(active):
+            self.start_workers(processes - len(active))
+        else:
+            for worker in sorted(active, key=lambda worker: len(worker.pending))[
+                    :len(active) - processes]:
+                worker.retiring = True
+                worker.tasks.put(None)
+        self._LOGGER.info('Resized pool from %d to %d processes', len(active), processes)
+        self.processes = processes
+
+    def capacity(self):
+        """Return the number of messages the pool handles at a time, to be
+        used as prefetch count.
+
+        """
+        return self.max_in_progress
+
+    def in_progress(self):
+        """Return the number of messages submitted and not completed yet."""
+        return len(self._pending)
+
+    def submit(self, token, basic_deliver, properties, body):
+        """Hand a message over to the least busy worker.
+
+        :param token: Returned by poll() once the message is handled
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param bytes body: The message body
+
+        """
+        self._task_id += 1
+        worker = min((worker for worker in self._workers if not worker.retiring),
+                     key=lambda worker: len(worker.pending))
+        length = len(body)
+        region = self._ring.allocate(length) if length else None
+        if region is not None:
+            ctypes.memmove(ctypes.addressof(self._buffer) + region[0], body, length)
+            offset, inline_body = region[0], None
+        else:
+            offset, inline_body = None, body
+        self._pending[self._task_id] = (worker, region, inline_body, token)
+        worker.pending.add(self._task_id)
+        worker.tasks.put((self._task_id, offset, length, inline_body,
+                          basic_deliver, properties))
+
+    def poll(self):
+        """Return the list of (token, error, body) tuples of the messages
+        completed since the last call. error is None on success, else the
+        exception raised by the handler or a WorkerError, and body is then a
+        copy of the message body. Replaces the workers which died.
+
+        """
+        completed = []
+        for worker in list(self._workers):
+            if self._drain(worker, completed) and worker.process.is_alive():
+                continue
+            # read what the worker sent right before exiting
+            worker.process.join()
+            self._drain(worker, completed)
+            self._remove(worker)
+            for task_id in sorted(worker.pending):
+                completed.append(self._complete(task_id, WorkerError(
+                    'Worker process %s died with exit code %s' %
+                    (worker.process.pid, worker.process.exitcode))))
+            if not worker.retiring:
+                self._LOGGER.error('Worker process %s died with exit code %s, replacing it',
+                                   worker.process.pid, worker.process.exitcode)
+                self.start_workers(1)
+        return completed
+
+    def _drain(self, worker, completed):
+        """Add the results a worker has sent to completed. Return False if
+        its pipe is closed.
+
+        """
+        try:
+            while worker.results.poll():
+                task_id, error = worker.results.recv()
+                completed.append(self._complete(task_id, error))
+        except (EOFError, IOError, OSError):
+            return False
+        return True
+
+    def _complete(self, task_id, error):
+        worker, region, inline_body, token = self._pending.pop(task_id)
+        worker.pending.discard(task_id)
+        body = None
+        if error is not None:
+            if region is None:
+                body = inline_body
+            else:
+                start = ctypes.addressof(self._buffer) + region[0]
+                body = ctypes.string_at(start, region[1])
+        if region is not None:
+            self._ring.free(region)
+        return token, error, body
+
+    def _remove(self, worker):
+        self._workers.remove(worker)
+        self._unwatch(worker)
+        worker.results.close()
+        worker.process.join()
+        # a dead worker leaves its unread tasks behind
+        worker.tasks.cancel_join_thread()
+        worker.tasks.close()
+
+    def close(self):
+        """Stop the worker processes once they finished their tasks. Return
+        the completions they reported meanwhile, like poll().
+
+        """
+        for worker in self._workers:
+            if worker.process.is_alive() and not worker.retiring:
+                worker.tasks.put(None)
+        completed = []
+        for worker in list(self._workers):
+            # keep reading, a worker blocks once its pipe is full
+            while self._drain(worker, completed) and worker.process.is_alive():
+                worker.process.join(0.01)
+            worker.process.join()
+            self._drain(worker, completed)
+            self._remove(worker)
+        self._ioloop = None
+        return completed
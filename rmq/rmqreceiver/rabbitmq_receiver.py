@@ -1,9 +1,18 @@
 import sys
+import copy
 import pika
 import signal
 import logging
+import functools
+from collections import OrderedDict
 from random import randint
 
+from rmq.rmqproducer import chunking
+from rmq.rmqreceiver.dispatch import TopicDispatcher
+from rmq.rmqreceiver.offsets import OffsetCheckpoint
+from rmq.rmqreceiver.reassembly import ChunkReassembler
+from rmq.rmqreceiver.retry import RetryPolicy
+
 
 class Receiver(object):
 
@@ -22,7 +31,8 @@ class Receiver(object):
         parameters used to connect to RabbitMQ.
 
         Other than consumer_callback, amqp_url, exchange the optional arguments are: 
-        exchange_type, queue, binding_keys, queue_exclusive, queue_durable, no_ack
+        exchange_type, queue, binding_keys, queue_exclusive, queue_durable, no_ack and
+        the ones listed below
 
         :param method consumer_callback: The method to callback when consuming (messages)
             with the signature consumer_callback(channel, method, properties, body), where
@@ -30,6 +40,8 @@ class Receiver(object):
                                 method: pika.spec.Basic.Deliver
                                 properties: pika.spec.BasicProperties
                                 body: str, unicode, or bytes (python 3.x)
+            If handlers are registered with add_handler(), it only receives the messages
+            no handler matches and may be None.
         :param str amqp_url: The AMQP url to connect with
         :param str exchange: Name of exchange
         :param str exchange_type: The exchange type to use. If no vaue is given for exchange 
@@ -38,7 +50,8 @@ class Receiver(object):
         :param str queue: Name of the queue. Its default value is ''. When the queue name is
                 empty string i.e. '', server chooses a random queue name for us.
         :param list binding_keys: The list of binding keys to be used. It's a list of strings. 
-                It's default value is [None]
+                It's default value is [None], or the patterns of the handlers registered with
+                add_handler() if there are any
         :param bool queue_exclusive: Only allow access by the current connection. This is
                 is the exclusive flag used in queue_declare() function of pika channel.
                 If the flag is true, consumer queue is deleted on disconnection. It's default
@@ -52,12 +65,87 @@ class Receiver(object):
                 default value is False
         :param bool safe_stop: If this option is True, system will try to gracefully stop the 
                 connection if the process is killed (with SIGTERM signal). Its default value is True
+        :param int prefetch_count: Number of unacknowledged messages RabbitMQ delivers to
+                this consumer at a time. It's default value is None i.e. unlimited
+        :param dedup_cache: A cache of processed message ids, e.g. an instance of
+                rmq.rmqreceiver.dedup.MessageIdCache or MmapMessageIdCache. When given,
+                messages whose message_id property was already processed are acknowledged
+                without calling consumer_callback. It's default value is None
+        :param retry_policy: An instance of rmq.rmqreceiver.retry.RetryPolicy. When given,
+                a message whose consumer_callback raises is republished to a delayed retry
+                queue, or to the parking queue once its retries are used up, instead of the
+                exception escaping into the IOLoop. The channel is put into confirm mode and
+                the message is acknowledged once RabbitMQ confirmed the republished copy, or
+                rejected and requeued if RabbitMQ refused it. Requires a named queue which
+                isn't a stream. It's default value is None
+        :param method transfer_callback: The method to callback with a payload published by
+                Publisher.publish_stream once all of its chunks arrived, with the signature
+                transfer_callback(channel, method, properties, fileobj) where method and
+                properties belong to the last chunk and fileobj is a spooled temporary file
+                holding the payload, closed when the callback returns. The chunks are
+                acknowledged once the callback returned, or earlier when the chunks of
+                incomplete payloads fill the prefetch_count window; such a payload isn't
+                redelivered if the callback raises without a retry policy or the consumer
+                crashes. If the callback raises, the retry policy republishes every chunk of
+                the payload. It's default value is None
+        :param method chunk_callback: The method to callback with every chunk of a payload
+                published by Publisher.publish_stream, in sequence order, with the signature
+                chunk_callback(channel, method, properties, chunk, last). Takes precedence
+                over transfer_callback. The chunks are acknowledged once the last one was
+                handled, or earlier when they fill the prefetch_count window. Can't be
+                combined with retry_policy. It's default value is None
+        :param int spool_max_size: Number of bytes of a payload given to transfer_callback
+                kept in memory before it is spooled to disk. It's default value is 1 MiB
+        :param float transfer_timeout: Seconds after which a payload whose chunks stopped
+                arriving is discarded. Its unacknowledged chunks are requeued. It's default
+                value is 300
+        :param str queue_type: The x-queue-type of the queue e.g. 'quorum' or 'stream'. A
+                stream queue must be named; it is always durable and not exclusive, and
+                messages are always acknowledged. It's default value is None i.e. a classic
+                queue
+        :param dict queue_arguments: Extra arguments used in queue_declare(). It's default
+                value is None
+        :param stream_offset: Where a stream queue consumer starts reading: 'first',
+                'last', 'next', a numeric offset, a datetime.datetime or an interval string
+                like '1h'. Ignored once an offset checkpoint exists. It's default value is
+                'next'
+        :param str offset_checkpoint: Path of a file in which the offset of the last
+                processed stream message is kept, so that a restarted consumer resumes after
+                it. It's default value is None
+        :param float checkpoint_interval: Minimum seconds between two writes of the offset
+                checkpoint file. It's default value is 5
+        :param int dispatch_cache_size: Number of routing keys whose matching handlers are
+                cached by the handler registry, 0 disabling the cache. It's default value is 10000
+        :param process_pool: An instance of rmq.rmqreceiver.process_pool.SharedMemoryPool.
+                When given, messages are handled by its worker processes instead of
+                consumer_callback, and acknowledged once a worker reports completion.
+                Failures go through the retry policy if there is one. Messages are always
+                acknowledged and prefetch_count defaults to the pool capacity. On stop() the
+                channel is closed once the messages in progress are completed. Can't be
+                combined with handlers, transfer_callback, chunk_callback or a stream queue,
+                whose offsets must be processed in order. It's default value is None
+        :param backlog_monitor: An instance of rmq.rmqreceiver.autoscale.BacklogMonitor.
+                When given, the message and consumer counts of the queue are polled on a
+                separate channel every backlog_monitor.interval seconds to estimate the
+                backlog, arrival and drain rates and to scale consumers. It's default value
+                is None
 
         """
         self._connection = None
         self._channel = None
         self._closing = False
         self._consumer_tag = None
+        self._stream_offset = None
+        self._monitor_channel = None
+        self._queue_name = None
+        self._confirms_channel = None
+        self._expiry_connection = None
+        self._close_when_idle = False
+        self._publish_number = 0
+        # publish sequence number -> callback settling the original of a
+        # republished message, in publish order
+        self._unconfirmed_retries = OrderedDict()
+        self.messages_processed = 0
         self._LOGGER = logging.getLogger(__name__)
         self.consumer_callback = consumer_callback
         self._url = amqp_url
@@ -72,16 +160,74 @@ class Receiver(object):
         self.exchange_type = kwargs.get('exchange_type')
         self.queue = kwargs.get('queue', '')
         self.binding_keys = kwargs.get('binding_keys', [None])
+        self._binding_keys_given = 'binding_keys' in kwargs
+        self._dispatcher = TopicDispatcher(kwargs.get('dispatch_cache_size', 10000))
         self.queue_exclusive = kwargs.get('queue_exclusive', False)
         self.queue_durable = kwargs.get('queue_durable', True)
         self.no_ack = kwargs.get('no_ack', False)
         self.safe_stop = kwargs.get('safe_stop', True)
+        self.prefetch_count = kwargs.get('prefetch_count')
+        self.queue_type = kwargs.get('queue_type')
+        self.queue_arguments = kwargs.get('queue_arguments') or {}
+        self.stream_offset = kwargs.get('stream_offset', 'next')
+        self._offset_checkpoint = None
+        if kwargs.get('offset_checkpoint'):
+            self._offset_checkpoint = OffsetCheckpoint(
+                kwargs['offset_checkpoint'], kwargs.get('checkpoint_interval', 5))
+            self._stream_offset = self._offset_checkpoint.offset
+        self.dedup_cache = kwargs.get('dedup_cache')
+        self.process_pool = kwargs.get('process_pool')
+        self.backlog_monitor = kwargs.get('backlog_monitor')
+        self.retry_policy = kwargs.get('retry_policy')
+        self.transfer_callback = kwargs.get('transfer_callback')
+        self.chunk_callback = kwargs.get('chunk_callback')
+        if self.process_pool is not None:
+            if self.transfer_callback or self.chunk_callback:
+                raise ValueError('process_pool can\'t be combined with transfer_callback '
+                                 'or chunk_callback')
+            if self.queue_type == 'stream':
+                # completions arrive out of order, but the stream offset only
+                # moves forward
+                raise ValueError('process_pool can\'t be combined with a stream queue')
+            if self.retry_policy is not None and self.process_pool.requeue_on_error:
+                raise ValueError('process_pool requeue_on_error can\'t be combined with '
+                                 'retry_policy')
+            self.no_ack = False
+            self.prefetch_count = self.prefetch_count or self.process_pool.capacity()
+        self._reassembler = None
+        # transfer id -> [sequence number, basic_deliver, properties, chunk
+        # size, acknowledged] of its chunks, which are acknowledged once it
+        # completes unless they had to be released earlier
+        self._transfer_deliveries = {}
+        if self.transfer_callback or self.chunk_callback:
+            self._reassembler = ChunkReassembler(
+                spool_max_size=kwargs.get('spool_max_size', 1024 * 1024),
+                transfer_timeout=kwargs.get('transfer_timeout', 300),
+                discard_callback=self.on_transfer_discarded)
+        if self.chunk_callback and self.retry_policy is not None:
+            # chunks already passed to chunk_callback can't be taken back
+            raise ValueError('chunk_callback can\'t be combined with retry_policy')
 
         # if queue name is empty string server will choose a random queue name
         # and we want this queue to be deleted when connection closes, hence
         # setting queue_exclusive True
         if not self.queue:
             self.queue_exclusive = True
+            if self.retry_policy is not None:
+                raise ValueError('retry_policy requires a named queue')
+            if self.queue_type == 'stream':
+                raise ValueError('stream queues require a named queue')
+        if self.retry_policy is not None and self.queue_type == 'stream':
+            # retries would be appended to the stream itself
+            raise ValueError('retry_policy can\'t be combined with a stream queue')
+
+        # stream queues have to be durable, shared and consumed with
+        # acknowledgements and a prefetch limit
+        if self.queue_type == 'stream':
+            self.queue_durable = True
+            self.queue_exclusive = False
+            self.no_ack = False
+            self.prefetch_count = self.prefetch_count or 1000
 
     def connect(self):
         """Connect to RabbitMQ, returning the connection handle.
@@ -263,8 +409,12 @@ class Receiver(object):
             self._LOGGER.info('Declaring queue with server defined queue name')
         else:
             self._LOGGER.info('Declaring queue %s', queue_name)
+        arguments = dict(self.queue_arguments)
+        if self.queue_type:
+            arguments['x-queue-type'] = self.queue_type
         self._channel.queue_declare(self.on_queue_declareok, queue=queue_name,
-                                    durable=self.queue_durable, exclusive=self.queue_exclusive)
+                                    durable=self.queue_durable, exclusive=self.queue_exclusive,
+                                    arguments=arguments or None)
 
     def on_queue_declareok(self, method_frame):
         """Invoked by pika when the Queue.Declare RPC call made in
@@ -274,10 +424,20 @@ class Receiver(object):
         routing key by issuing the Queue.Bind RPC command. When this command
         is complete, the on_bindok method will be invoked by pika.
 
+        Queues can't be bound to the default exchange (''), which already
+        routes messages to the queue of the same name as the routing key, so
+        in that case binding is skipped.
+
         :param pika.frame.Method method_frame: The Queue.DeclareOk frame
 
         """
-
+        self._queue_name = method_frame.method.queue
+        if not self.exchange:
+            self._LOGGER.info('Using the default exchange, no binding needed')
+            self.on_queue_bound()
+            return
+        if self._dispatcher and not self._binding_keys_given:
+            self.binding_keys = self._dispatcher.patterns()
         if self.queue == '':
             self._LOGGER.info('Binding %s to server defined queue with %s',
                               self.exchange, ','.join(self.binding_keys))
@@ -301,6 +461,53 @@ class Receiver(object):
         self.keys_bound_to_queue += 1
         if self.keys_bound_to_queue == len(self.binding_keys):
             self._LOGGER.info('Queue bound')
+            self.on_queue_bound()
+
+    def on_queue_bound(self):
+        """Invoked once the queue is bound with all of its binding keys.
+        Declares the retry queues if there is a retry policy, else starts
+        consuming.
+
+        """
+        if self.retry_policy is not None:
+            self.setup_retry_queues()
+        else:
+            self.start_consuming()
+
+    def setup_retry_queues(self):
+        """Declare the retry queues and the parking queue of the retry policy.
+
+        Every retry queue holds messages for its delay and then dead letters
+        them back to the consumer queue. When all of them are declared, the
+        on_retry_queue_declareok method will start consuming.
+
+        """
+        delays = self.retry_policy.delays()
+        self.retry_queues_declared = 0
+        self.retry_queues_to_declare = len(delays) + 1
+        for delay in delays:
+            retry_queue = self.retry_policy.retry_queue(self.queue, delay)
+            self._LOGGER.info('Declaring retry queue %s', retry_queue)
+            self._channel.queue_declare(
+                self.on_retry_queue_declareok, queue=retry_queue,
+                durable=self.queue_durable,
+                arguments=self.retry_policy.retry_queue_arguments(self.queue, delay))
+        parking_queue = self.retry_policy.parking_queue(self.queue)
+        self._LOGGER.info('Declaring parking queue %s', parking_queue)
+        self._channel.queue_declare(self.on_retry_queue_declareok,
+                                    queue=parking_queue, durable=self.queue_durable)
+
+    def on_retry_queue_declareok(self, unused_frame):
+        """Invoked by pika when a Queue.Declare RPC call made in
+        setup_retry_queues has completed. Starts consuming once every retry
+        queue and the parking queue exist.
+
+        :param pika.frame.Method unused_frame: The Queue.DeclareOk frame
+
+        """
+        self.retry_queues_declared += 1
+        if self.retry_queues_declared == self.retry_queues_to_declare:
+            self._LOGGER.info('Retry queues declared')
             self.start_consuming()
 
     def start_consuming(self):
@@ -316,8 +523,123 @@ class Receiver(object):
         """
         self._LOGGER.info('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
+        self.reset_transfers()
+        if self.retry_policy is not None:
+            self.enable_confirms()
+        if self._reassembler is not None:
+            self.schedule_transfer_expiry()
+        if self.prefetch_count:
+            self._channel.basic_qos(prefetch_count=self.prefetch_count)
+        arguments = None
+        if self.queue_type == 'stream':
+            arguments = {'x-stream-offset': self.stream_start_offset()}
+            self._LOGGER.info('Consuming stream %s from offset %s',
+                              self.queue, arguments['x-stream-offset'])
         self._consumer_tag = self._channel.basic_consume(self.on_message,
-                                                         self.queue, no_ack = self.no_ack)
+                                                         self.queue, no_ack = self.no_ack,
+                                                         arguments=arguments)
+        if self.process_pool is not None:
+            self.process_pool.attach(self._connection.ioloop, self.poll_process_pool)
+        if self.backlog_monitor is not None:
+            self._connection.channel(on_open_callback=self.on_monitor_channel_open)
+
+    def enable_confirms(self):
+        """Put the channel into confirm mode, once per channel. Republished
+        messages are then settled by on_delivery_confirmation.
+
+        """
+        if self._confirms_channel is self._channel:
+            return
+        self._LOGGER.info('Issuing Confirm.Select RPC command')
+        self._confirms_channel = self._channel
+        # sequence numbers restart and the originals of unconfirmed
+        # republishes are redelivered on the new channel
+        self._publish_number = 0
+        self._unconfirmed_retries = OrderedDict()
+        self._channel.confirm_delivery(self.on_delivery_confirmation)
+
+    def on_delivery_confirmation(self, method_frame):
+        """Invoked by pika when RabbitMQ confirms or rejects republished
+        messages, possibly several at once with the multiple flag. Settles
+        their original deliveries.
+
+        :param pika.frame.Method method_frame: Basic.Ack or Basic.Nack frame
+
+        """
+        confirmed = method_frame.method.NAME.split('.')[1].lower() == 'ack'
+        publish_number = method_frame.method.delivery_tag
+        if method_frame.method.multiple:
+            settled = []
+            while (self._unconfirmed_retries and
+                   next(iter(self._unconfirmed_retries)) <= publish_number):
+                settled.append(self._unconfirmed_retries.popitem(last=False)[1])
+        else:
+            settled = [self._unconfirmed_retries.pop(publish_number, None)]
+        for on_settled in settled:
+            if on_settled is not None:
+                on_settled(confirmed)
+        self.close_channel_when_idle()
+
+    def on_monitor_channel_open(self, channel):
+        """Invoked by pika when the side channel used to poll the queue
+        counts has been opened. A failing passive declare closes this channel
+        only, so it must not share the channel of the consumer.
+
+        :param pika.channel.Channel channel: The channel object
+
+        """
+        self._LOGGER.info('Backlog monitor channel opened')
+        self._monitor_channel = channel
+        channel.add_on_close_callback(self.on_monitor_channel_closed)
+        self.poll_backlog()
+
+    def on_monitor_channel_closed(self, channel, reply_code, reply_text):
+        """Invoked by pika when the backlog monitor channel is closed. Stops
+        monitoring until the next reconnection.
+
+        :param pika.channel.Channel: The closed channel
+        :param int reply_code: The numeric reason the channel was closed
+        :param str reply_text: The text reason the channel was closed
+
+        """
+        if not self._closing:
+            self._LOGGER.warning('Backlog monitor channel was closed: (%s) %s',
+                                 reply_code, reply_text)
+        self._monitor_channel = None
+
+    def poll_backlog(self):
+        """Issue a passive Queue.Declare on the monitor channel to read the
+        message and consumer counts of the queue. The on_backlog_declareok
+        method will be invoked by pika with the result.
+
+        """
+        if self._closing or not (self._monitor_channel and self._monitor_channel.is_open):
+            return
+        self._monitor_channel.queue_declare(self.on_backlog_declareok,
+                                            queue=self._queue_name, passive=True)
+
+    def on_backlog_declareok(self, method_frame):
+        """Invoked by pika with the counts of the queue. Passes them to the
+        backlog monitor and schedules the next poll.
+
+        :param pika.frame.Method method_frame: The Queue.DeclareOk frame
+
+        """
+        self.backlog_monitor.update(method_frame.method.message_count,
+                                    method_frame.method.consumer_count,
+                                    self.messages_processed)
+        self._LOGGER.debug('Backlog: %s', self.backlog_monitor.stats())
+        self._connection.add_timeout(self.backlog_monitor.interval, self.poll_backlog)
+
+    def stream_start_offset(self):
+        """Return the x-stream-offset to start consuming a stream queue from:
+        right after the last processed message if there is one (from this run
+        or from the offset checkpoint), else the configured stream_offset.
+
+        """
+        if self._stream_offset is not None:
+            return self._stream_offset + 1
+        return self.stream_offset
 
     def add_on_cancel_callback(self):
         """Add a callback that will be invoked if RabbitMQ cancels the consumer
@@ -357,9 +679,403 @@ class Receiver(object):
         self._LOGGER.debug('Received message # %s from %s',
                            basic_deliver.delivery_tag, properties.app_id)
         self._LOGGER.debug('Message Received: %s', body)
-        self.consumer_callback(unused_channel, basic_deliver, properties, body)
+        message_id = properties.message_id
+        if self.is_duplicate(message_id):
+            self._LOGGER.debug('Skipping duplicate message %s', message_id)
+            self.message_processed(basic_deliver, properties)
+            return
+        if self.process_pool is not None:
+            # acknowledged by poll_process_pool once a worker is done with it
+            self.process_pool.submit((self._channel, basic_deliver, properties),
+                                     basic_deliver, properties, body)
+            return
+        if (self._reassembler is not None and
+                chunking.TRANSFER_ID_HEADER in (properties.headers or {})):
+            # acknowledged by on_chunk once its transfer is complete
+            self.on_chunk(unused_channel, basic_deliver, properties, body)
+            return
+        try:
+            self.dispatch_message(unused_channel, basic_deliver, properties, body)
+        except Exception as error:
+            if self.retry_policy is None:
+                raise
+            # settled once the republished copy is confirmed
+            self.retry_message(basic_deliver, properties, body, error)
+            return
+        self.remember_message(basic_deliver, properties)
+        self.message_processed(basic_deliver, properties)
+
+    def poll_process_pool(self):
+        """Invoked by the IOLoop when a worker process of the process pool
+        reports completions or dies. Acknowledges the completed messages and
+        retries the failed ones if there is a retry policy, else rejects them.
+        Completions of messages delivered on a channel which has been closed
+        meanwhile are dropped, as RabbitMQ redelivers those.
+
+        """
+        for (channel, basic_deliver, properties), error, body in self.process_pool.poll():
+            if channel is not self._channel or not channel.is_open:
+                continue
+            if error is None:
+                self.remember_message(basic_deliver, properties)
+                self.message_processed(basic_deliver, properties)
+            elif self.retry_policy is not None:
+                self.retry_message(basic_deliver, properties, body, error)
+            else:
+                self._LOGGER.error('Worker failed to handle message %s: %r',
+                                   basic_deliver.delivery_tag, error)
+                self._channel.basic_nack(basic_deliver.delivery_tag,
+                                         requeue=self.process_pool.requeue_on_error)
+        self.close_channel_when_idle()
+
+    def message_processed(self, basic_deliver, properties):
+        """Invoked once a message has been dealt with. Acknowledges it and,
+        for stream queues, records its offset.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+
+        """
+        self.messages_processed += 1
         if not self.no_ack:
             self.acknowledge_message(basic_deliver.delivery_tag)
+        self.record_stream_offset(properties)
+
+    def record_stream_offset(self, properties):
+        """For stream queues, record the offset of a message which has been
+        dealt with as the one to resume after.
+
+        :param pika.Spec.BasicProperties: properties
+
+        """
+        if self.queue_type != 'stream':
+            return
+        offset = (properties.headers or {}).get('x-stream-offset')
+        if offset is not None:
+            self._stream_offset = offset
+            if self._offset_checkpoint is not None:
+                self._offset_checkpoint.update(offset)
+
+    def dispatch_message(self, channel, basic_deliver, properties, body):
+        """Hand a message over to the callback it is meant for: messages
+        whose routing key matches registered handlers go to those handlers and
+        everything else to consumer_callback.
+
+        :param pika.channel.Channel channel: The channel object
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param str|unicode body: The message body
+
+        """
+        handlers = ()
+        if self._dispatcher:
+            routing_key = basic_deliver.routing_key
+            if self.retry_policy is not None:
+                # retried messages come back with the queue name as routing key
+                routing_key = (properties.headers or {}).get(
+                    RetryPolicy.ROUTING_KEY_HEADER, routing_key)
+            handlers = self._dispatcher.match(routing_key)
+        for handler in handlers:
+            handler(channel, basic_deliver, properties, body)
+        if handlers:
+            return
+        if self.consumer_callback is not None:
+            self.consumer_callback(channel, basic_deliver, properties, body)
+        else:
+            self._LOGGER.warning('No handler for routing key %s, dropping message %s',
+                                 basic_deliver.routing_key, basic_deliver.delivery_tag)
+
+    def add_handler(self, pattern, handler):
+        """Register a handler for the messages whose routing key matches an
+        AMQP topic pattern ('*' matches one word, '#' zero or more words).
+        Unless binding_keys were given, the queue is bound with the patterns
+        of the registered handlers. Register handlers before calling run().
+
+        A message matching several patterns is passed to each of their
+        handlers, in registration order. If one of them raises, the handlers
+        after it are skipped and the retry policy retries the message as a
+        whole, i.e. the handlers before it run again: handlers sharing a
+        pattern space must be idempotent.
+
+        :param str pattern: The topic pattern e.g. 'order.*.created'
+        :param method handler: The method to callback with the signature
+                handler(channel, method, properties, body)
+
+        """
+        if self.process_pool is not None:
+            raise ValueError('Handlers can\'t be combined with a process_pool')
+        self._dispatcher.add(pattern, handler)
+
+    def route(self, pattern):
+        """Decorator form of add_handler()."""
+        def decorator(handler):
+            self.add_handler(pattern, handler)
+            return handler
+        return decorator
+
+    def on_chunk(self, channel, basic_deliver, properties, body):
+        """Invoked for every chunk of a streamed payload. Passes the chunks
+        which are next in order to chunk_callback, or spools them and calls
+        transfer_callback once the payload is complete. The chunks of a
+        payload are acknowledged together after the last callback returned.
+
+        :param pika.channel.Channel channel: The channel object
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param bytes body: The chunk
+
+        """
+        headers = properties.headers
+        transfer_id = headers[chunking.TRANSFER_ID_HEADER]
+        sequence_number = headers[chunking.CHUNK_SEQ_HEADER]
+        last = headers.get(chunking.CHUNK_LAST_HEADER, False)
+        self._transfer_deliveries.setdefault(transfer_id, []).append(
+            [sequence_number, basic_deliver, properties, len(body), False])
+        if self.chunk_callback:
+            for chunk, is_last in self._reassembler.feed(transfer_id, sequence_number,
+                                                         last, body):
+                self.chunk_callback(channel, basic_deliver, properties, chunk, is_last)
+                if is_last:
+                    self.transfer_processed(transfer_id)
+                    return
+            self.release_chunks()
+            return
+        payload = self._reassembler.spool(transfer_id, sequence_number, last, body)
+        if payload is None:
+            self.release_chunks()
+            return
+        self._LOGGER.debug('Transfer %s complete', transfer_id)
+        try:
+            try:
+                self.transfer_callback(channel, basic_deliver, properties, payload)
+            except Exception as error:
+                if self.retry_policy is None:
+                    # the chunks stay unacknowledged and the whole payload
+                    # is redelivered by RabbitMQ
+                    deliveries = self._transfer_deliveries.pop(transfer_id, [])
+                    if any(delivery[4] for delivery in deliveries):
+                        self._LOGGER.error('Transfer %s failed after some of its chunks were '
+                                           'acknowledged, it won\'t be redelivered whole',
+                                           transfer_id)
+                    raise
+                self.retry_transfer(transfer_id, payload, error)
+                return
+        finally:
+            payload.close()
+        self.transfer_processed(transfer_id)
+
+    def transfer_processed(self, transfer_id):
+        """Acknowledge every chunk of a transfer which has been dealt with.
+
+        :param str transfer_id: The x-transfer-id header of the chunks
+
+        """
+        deliveries = self._transfer_deliveries.pop(transfer_id, [])
+        for _, basic_deliver, properties, _, acknowledged in sorted(
+                deliveries, key=lambda delivery: delivery[1].delivery_tag):
+            self.remember_message(basic_deliver, properties)
+            if not acknowledged:
+                self.message_processed(basic_deliver, properties)
+
+    def release_chunks(self):
+        """Acknowledge the chunks held for incomplete transfers once they
+        fill the prefetch window, since RabbitMQ wouldn't deliver the rest of
+        their transfers otherwise. The reassembler keeps their contents, but
+        they aren't redelivered if their transfer fails or the consumer
+        crashes.
+
+        """
+        if not self.prefetch_count or self.no_ack:
+            return
+        held = [delivery for deliveries in self._transfer_deliveries.values()
+                for delivery in deliveries if not delivery[4]]
+        if len(held) < self.prefetch_count:
+            return
+        self._LOGGER.warning('%d chunks of incomplete transfers fill the prefetch window, '
+                             'acknowledging them', len(held))
+        for delivery in sorted(held, key=lambda delivery: delivery[1].delivery_tag):
+            delivery[4] = True
+            self.message_processed(delivery[1], delivery[2])
+
+    def schedule_transfer_expiry(self):
+        """Check for timed out transfers every second on the IOLoop of the
+        connection, as their chunks may have stopped arriving altogether.
+
+        """
+        if self._expiry_connection is self._connection:
+            return
+        self._expiry_connection = self._connection
+        self._connection.add_timeout(1, functools.partial(self.expire_transfers,
+                                                          self._connection))
+
+    def expire_transfers(self, connection):
+        """Invoked by the IOLoop timer to discard the timed out transfers.
+
+        :param pika.SelectConnection connection: The connection whose IOLoop
+                runs the timer
+
+        """
+        if self._closing or connection is not self._connection:
+            return
+        self._reassembler.expire()
+        connection.add_timeout(1, functools.partial(self.expire_transfers, connection))
+
+    def retry_transfer(self, transfer_id, payload, error):
+        """Republish every chunk of a transfer whose transfer_callback
+        failed, reading them back from the spooled payload, so that the whole
+        payload is retried or parked together. The chunks are settled together
+        once every republished chunk is confirmed.
+
+        :param str transfer_id: The x-transfer-id header of the chunks
+        :param payload: The spooled payload
+        :param Exception error: The exception raised by transfer_callback
+
+        """
+        deliveries = sorted(self._transfer_deliveries.pop(transfer_id, []),
+                            key=lambda delivery: delivery[0])
+        chunks = []
+        for delivery in deliveries:
+            if not chunks or chunks[-1][0] != delivery[0]:
+                # redelivered chunks are republished once
+                chunks.append(delivery)
+        # number of unconfirmed republished chunks and whether RabbitMQ
+        # rejected one of them
+        outcome = {'unconfirmed': len(chunks), 'rejected': False}
+        on_settled = functools.partial(self.transfer_retry_settled, deliveries, outcome)
+        payload.seek(0)
+        for _, basic_deliver, properties, size, _ in chunks:
+            self.retry_message(basic_deliver, properties, payload.read(size), error,
+                               on_settled=on_settled)
+
+    def transfer_retry_settled(self, deliveries, outcome, confirmed):
+        """Invoked for every confirmation of a chunk republished by
+        retry_transfer. Settles all chunks of the transfer with the last one.
+
+        :param list deliveries: The deliveries of the chunks of the transfer
+        :param dict outcome: The confirmations still missing and whether one
+                of the chunks was rejected
+        :param bool confirmed: Whether RabbitMQ confirmed the chunk
+
+        """
+        outcome['unconfirmed'] -= 1
+        outcome['rejected'] = outcome['rejected'] or not confirmed
+        if outcome['unconfirmed']:
+            return
+        for _, basic_deliver, properties, _, acknowledged in sorted(
+                deliveries, key=lambda delivery: delivery[1].delivery_tag):
+            if not acknowledged:
+                self.retry_settled(basic_deliver, properties, not outcome['rejected'])
+
+    def on_transfer_discarded(self, transfer_id):
+        """Invoked by the reassembler when an incomplete transfer timed out
+        or had too many chunks out of order. Rejects and requeues its chunks,
+        so that they aren't lost if the transfer completes later on.
+
+        :param str transfer_id: The x-transfer-id header of the chunks
+
+        """
+        deliveries = self._transfer_deliveries.pop(transfer_id, [])
+        if self.no_ack:
+            return
+        released = 0
+        for _, basic_deliver, _, _, acknowledged in sorted(
+                deliveries, key=lambda delivery: delivery[1].delivery_tag):
+            if acknowledged:
+                released += 1
+            else:
+                self._channel.basic_nack(basic_deliver.delivery_tag, requeue=True)
+        if released:
+            self._LOGGER.error('Lost %d acknowledged chunks of discarded transfer %s',
+                               released, transfer_id)
+
+    def reset_transfers(self):
+        """Forget the incomplete transfers. Invoked for every new consumer,
+        since RabbitMQ redelivers their unacknowledged chunks.
+
+        """
+        self._transfer_deliveries = {}
+        if self._reassembler is not None:
+            self._reassembler.close()
+
+    def retry_message(self, basic_deliver, properties, body, error, on_settled=None):
+        """Republish a message whose consumer_callback failed to the retry
+        queue matching its number of failed attempts, or to the parking queue
+        if the retry policy gives up on it. The original message is settled
+        once RabbitMQ confirmed or rejected the republished copy.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param str|unicode body: The message body
+        :param Exception error: The exception raised by consumer_callback
+        :param method on_settled: The method to callback with the signature
+                on_settled(confirmed) once the republished copy is confirmed or
+                rejected. It's default value is None i.e. retry_settled for
+                this message
+
+        """
+        headers = dict(properties.headers or {})
+        attempts = headers.get(self.retry_policy.ATTEMPTS_HEADER, 0) + 1
+        headers[self.retry_policy.ATTEMPTS_HEADER] = attempts
+        headers.setdefault(self.retry_policy.ROUTING_KEY_HEADER,
+                           basic_deliver.routing_key)
+        retry_properties = copy.copy(properties)
+        retry_properties.headers = headers
+        if self.retry_policy.should_retry(error, attempts):
+            delay = self.retry_policy.delay(attempts)
+            target_queue = self.retry_policy.retry_queue(self.queue, delay)
+            self._LOGGER.warning('Message %s failed (attempt %d), retrying in %d ms: %r',
+                                 basic_deliver.delivery_tag, attempts, delay, error)
+        else:
+            target_queue = self.retry_policy.parking_queue(self.queue)
+            self._LOGGER.error('Message %s failed (attempt %d), parking it in %s: %r',
+                               basic_deliver.delivery_tag, attempts, target_queue, error)
+        self._channel.basic_publish('', target_queue, body, properties=retry_properties)
+        self._publish_number += 1
+        if on_settled is None:
+            on_settled = functools.partial(self.retry_settled, basic_deliver, properties)
+        self._unconfirmed_retries[self._publish_number] = on_settled
+
+    def retry_settled(self, basic_deliver, properties, confirmed):
+        """Invoked once RabbitMQ confirmed or rejected the republished copy
+        of a failed message. Acknowledges the original if the copy is safe,
+        else rejects and requeues it so that it is retried again.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param bool confirmed: Whether RabbitMQ confirmed the republished copy
+
+        """
+        if confirmed:
+            self.message_processed(basic_deliver, properties)
+            return
+        self._LOGGER.error('Republished copy of message %s was rejected, requeueing it',
+                           basic_deliver.delivery_tag)
+        if not self.no_ack:
+            self._channel.basic_nack(basic_deliver.delivery_tag, requeue=True)
+
+    def remember_message(self, basic_deliver, properties):
+        """Add the message_id of a successfully handled message to the dedup
+        cache, if there is one. Invoked right before the message is
+        acknowledged.
+
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+
+        """
+        if self.dedup_cache is not None and properties.message_id:
+            self.dedup_cache.add(properties.message_id)
+
+    def is_duplicate(self, message_id):
+        """Check if a message with the given message_id has already been
+        processed. Messages without a message_id are never treated as
+        duplicates.
+
+        :param str message_id: The message_id property of the message
+
+        """
+        if self.dedup_cache is None or not message_id:
+            return False
+        return self.dedup_cache.seen(message_id)
 
     def acknowledge_message(self, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
@@ -383,16 +1099,42 @@ class Receiver(object):
     def on_cancelok(self, unused_frame):
         """Invoked by pika when RabbitMQ acknowledges the cancellation of a consumer.
 
-        At this point we will close the channel. This will invoke the
-        on_channel_closed method once the channel has been closed, which will
-        in-turn close the connection.
+        At this point we will close the channel, as soon as the messages in
+        progress are settled. This will invoke the on_channel_closed method
+        once the channel has been closed, which will in-turn close the
+        connection.
 
         :param pika.frame.Method unused_frame: The Basic.CancelOk frame
 
         """
         self._LOGGER.info(
             'RabbitMQ acknowledged the cancellation of the consumer')
-        self.close_channel()
+        self._close_when_idle = True
+        self.close_channel_when_idle()
+
+    def is_idle(self):
+        """Return True unless worker processes are busy with messages or
+        republished messages wait for their confirmation. Closing the channel
+        would requeue those messages.
+
+        """
+        if self.process_pool is not None and self.process_pool.in_progress():
+            return False
+        return not self._unconfirmed_retries
+
+    def close_channel_when_idle(self):
+        """Close the channel once the consumer has been cancelled and the
+        messages in progress are settled.
+
+        """
+        if not self._close_when_idle:
+            return
+        if not self.is_idle():
+            self._LOGGER.info('Waiting for the messages in progress to be settled')
+            return
+        self._close_when_idle = False
+        if self._channel is not None and self._channel.is_open:
+            self.close_channel()
 
     def close_channel(self):
         """Close the channel with RabbitMQ cleanly by issuing the
@@ -443,6 +1185,17 @@ class Receiver(object):
         self._closing = True
         self.stop_consuming()
         self._connection.ioloop.start()
+        if self.dedup_cache is not None:
+            self.dedup_cache.close()
+        if self._reassembler is not None:
+            self._reassembler.close()
+        if self._offset_checkpoint is not None:
+            self._offset_checkpoint.close()
+        if self.process_pool is not None:
+            completed = self.process_pool.close()
+            if completed:
+                self._LOGGER.warning('%d messages were completed after the channel was '
+                                     'closed, RabbitMQ redelivers them', len(completed))
         self._LOGGER.info('Stopped')
 
     def close_connection(self):
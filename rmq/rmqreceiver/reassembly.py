@@ -0,0 +1,135 @@
+import time
+import logging
+import tempfile
+
+
+class ChunkReassembler(object):
+    """Puts the chunks of payloads published with Publisher.publish_stream
+    back in order.
+
+    Chunks are released in sequence order as soon as they are contiguous, so
+    only chunks that arrive ahead of a missing one are held in memory, and at
+    most max_pending_chunks of them per transfer. Duplicated chunks are
+    dropped. Transfers which haven't received a chunk for transfer_timeout
+    seconds, or with too many chunks out of order, are discarded and reported
+    to discard_callback.
+
+    """
+
+    def __init__(self, spool_max_size=1024 * 1024, transfer_timeout=300,
+                 max_pending_chunks=16, discard_callback=None):
+        """
+        :param int spool_max_size: Number of bytes of a spooled payload kept
+                in memory before it is moved to a temporary file on disk. It's
+                default value is 1 MiB
+        :param float transfer_timeout: Seconds after which an incomplete
+                transfer is discarded. It's default value is 300
+        :param int max_pending_chunks: Number of out of order chunks held per
+                transfer before the transfer is discarded. It's default value
+                is 16
+        :param method discard_callback: The method to callback with the
+                transfer id of a transfer discarded because it timed out or
+                had too many out of order chunks. It's default value is None
+
+        """
+        self._LOGGER = logging.getLogger(__name__)
+        self.spool_max_size = spool_max_size
+        self.transfer_timeout = transfer_timeout
+        self.max_pending_chunks = max_pending_chunks
+        self.discard_callback = discard_callback
+        self._transfers = {}
+        self._last_expiry_check = time.time()
+
+    def feed(self, transfer_id, sequence_number, last, chunk):
+        """Add a chunk to its transfer and return the list of (chunk, last)
+        tuples which are now next in order. The list is empty if the chunk is
+        a duplicate or arrived ahead of a missing one.
+
+        :param str transfer_id: The x-transfer-id header of the chunk
+        :param int sequence_number: The x-chunk-seq header of the chunk
+        :param bool last: The x-chunk-last header of the chunk
+        :param bytes chunk: The message body
+
+        """
+        now = time.time()
+        self.expire(now)
+        transfer = self._transfers.get(transfer_id)
+        if transfer is None:
+            transfer = {'next': 0, 'pending': {}, 'file': None}
+            self._transfers[transfer_id] = transfer
+        transfer['updated_at'] = now
+        if sequence_number < transfer['next'] or sequence_number in transfer['pending']:
+            self._LOGGER.debug('Dropping duplicate chunk %s of transfer %s',
+                               sequence_number, transfer_id)
+            return []
+        transfer['pending'][sequence_number] = (chunk, last)
+        if len(transfer['pending']) > self.max_pending_chunks:
+            self._LOGGER.error('Too many out of order chunks, discarding transfer %s',
+                               transfer_id)
+            self.drop(transfer_id)
+            return []
+        ready = []
+        while transfer['next'] in transfer['pending']:
+            chunk, last = transfer['pending'].pop(transfer['next'])
+            transfer['next'] += 1
+            ready.append((chunk, last))
+            if last:
+                self._transfers.pop(transfer_id, None)
+                break
+        return ready
+
+    def spool(self, transfer_id, sequence_number, last, chunk):
+        """Add a chunk to its transfer, writing the in order chunks to a
+        spooled temporary file. Return the file, rewound to the start, once
+        the last chunk has been written and None before that. The caller is
+        responsible for closing the returned file.
+
+        Takes the same arguments as feed().
+
+        """
+        transfer = self._transfers.get(transfer_id)
+        spool_file = transfer and transfer['file']
+        for data, is_last in self.feed(transfer_id, sequence_number, last, chunk):
+            if spool_file is None:
+                spool_file = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+            spool_file.write(data)
+            if is_last:
+                spool_file.seek(0)
+                return spool_file
+        if transfer_id in self._transfers:
+            self._transfers[transfer_id]['file'] = spool_file
+        elif spool_file is not None:
+            spool_file.close()
+        return None
+
+    def discard(self, transfer_id):
+        """Forget a transfer and delete its spooled data."""
+        transfer = self._transfers.pop(transfer_id, None)
+        if transfer and transfer['file'] is not None:
+            transfer['file'].close()
+
+    def drop(self, transfer_id):
+        """Discard a transfer which can't complete and report it to
+        discard_callback.
+
+        """
+        self.discard(transfer_id)
+        if self.discard_callback is not None:
+            self.discard_callback(transfer_id)
+
+    def expire(self, now=None):
+        """Discard the transfers which timed out. Runs at most once a second."""
+        if now is None:
+            now = time.time()
+        if now - self._last_expiry_check < 1:
+            return
+        self._last_expiry_check = now
+        for transfer_id, transfer in list(self._transfers.items()):
+            if now - transfer['updated_at'] > self.transfer_timeout:
+                self._LOGGER.warning('Transfer %s timed out, discarding it', transfer_id)
+                self.drop(transfer_id)
+
+    def close(self):
+        """Discard every incomplete transfer."""
+        for transfer_id in list(self._transfers):
+            self.discard(transfer_id)
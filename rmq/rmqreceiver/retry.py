@@ -0,0 +1,92 @@
+class RetryPolicy(object):
+    """Decides what happens to a message whose consumer_callback raised an
+    exception.
+
+    Retryable failures are republished to a retry queue whose messages expire
+    after a delay and are then dead lettered back to the consumer queue. Each
+    retry waits longer than the previous one (initial_delay * multiplier **
+    retry_number, capped at max_delay) and every distinct delay gets its own
+    retry queue. Messages which exhausted their retries, or failed with an
+    exception that isn't retryable, are moved to the parking queue where they
+    stay until somebody looks at them.
+
+    The number of failed attempts travels with the message in the
+    x-retry-attempts header and the routing key it was originally published
+    with in the x-retry-routing-key header.
+
+    """
+
+    ATTEMPTS_HEADER = 'x-retry-attempts'
+    ROUTING_KEY_HEADER = 'x-retry-routing-key'
+
+    def __init__(self, max_retries=5, initial_delay=1, multiplier=2,
+                 max_delay=300, retry_on=(Exception,)):
+        """
+        :param int max_retries: Number of times a message is retried before it
+                is parked. It's default value is 5
+        :param float initial_delay: Seconds to wait before the first retry.
+                It's default value is 1
+        :param float multiplier: Factor by which the delay grows with every
+                retry. It's default value is 2
+        :param float max_delay: Upper bound of the delay in seconds. It's
+                default value is 300
+        :param tuple retry_on: Exception classes which are worth retrying. Any
+                other exception parks the message straight away. It's default
+                value is (Exception,)
+
+        """
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+
+    def delay(self, attempts):
+        """Return the delay in milliseconds before retrying a message which
+        has failed the given number of times.
+
+        :param int attempts: Number of failed attempts, starting at 1
+
+        """
+        seconds = min(self.initial_delay * self.multiplier ** (attempts - 1),
+                      self.max_delay)
+        return int(seconds * 1000)
+
+    def delays(self):
+        """Return the sorted list of distinct delays (in milliseconds) used by
+        this policy, one per retry queue.
+
+        """
+        return sorted(set(self.delay(attempts)
+                          for attempts in range(1, self.max_retries + 1)))
+
+    def should_retry(self, error, attempts):
+        """Return True if a message which has now failed the given number of
+        times with the given exception should be retried.
+
+        :param Exception error: The exception raised by consumer_callback
+        :param int attempts: Number of failed attempts, including this one
+
+        """
+        return isinstance(error, self.retry_on) and attempts <= self.max_retries
+
+    def retry_queue(self, queue, delay):
+        """Return the name of the retry queue of the given consumer queue for
+        the given delay in milliseconds.
+
+        """
+        return '%s.retry.%d' % (queue, delay)
+
+    def parking_queue(self, queue):
+        """Return the name of the parking queue of the given consumer queue."""
+        return '%s.parking' % queue
+
+    def retry_queue_arguments(self, queue, delay):
+        """Return the queue_declare() arguments of a retry queue, which dead
+        letters expired messages back to the consumer queue through the
+        default exchange.
+
+        """
+        return {'x-message-ttl': delay,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': queue}
@@ -0,0 +1,381 @@
+import time
+import uuid
+import heapq
+import logging
+
+import pika
+
+REPLY_TO = 'amq.rabbitmq.reply-to'
+ERROR_HEADER = 'x-rpc-error'
+
+
+class RpcError(Exception):
+    """Raised by RpcFuture.result() when the call failed on the server or the
+    connection was lost before the reply arrived.
+
+    """
+
+
+class RpcTimeout(RpcError):
+    """Raised by RpcFuture.result() when no reply arrived in time."""
+
+
+class RpcFuture(object):
+    """The pending result of a call made with RpcClient.call_async().
+
+    """
+
+    def __init__(self, client, correlation_id, deadline):
+        self._client = client
+        self.correlation_id = correlation_id
+        self.deadline = deadline
+        self._done = False
+        self._body = None
+        self._properties = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """Return True once the reply arrived or the call failed."""
+        return self._done
+
+    def result(self, timeout=None):
+        """Return the body of the reply, running the IOLoop of the client
+        until it arrives. Other calls that complete meanwhile are resolved as
+        well.
+
+        :param float timeout: Seconds to wait at most. The deadline of the
+                call still applies, the earlier of the two wins. It's default
+                value is None i.e. until the deadline
+        :raises RpcTimeout: If no reply arrived in time
+        :raises RpcError: If the server failed or the connection was lost
+
+        """
+        if not self._done:
+            self._client.wait(self, timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._body
+
+    @property
+    def properties(self):
+        """The pika.spec.BasicProperties of the reply, None until it arrived."""
+        return self._properties
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once the call completes, right away if it
+        already has.
+
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, body, properties):
+        self._body = body
+        self._properties = properties
+        self._complete()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._complete()
+
+    def _complete(self):
+        self._done = True
+        for callback in self._callbacks:
+            callback(self)
+        self._callbacks = []
+
+
+class RpcClient(object):
+    """Request/reply client using RabbitMQ direct reply-to.
+
+    Replies are consumed from the amq.rabbitmq.reply-to pseudo queue on the
+    same channel the requests are published on, so no reply queue has to be
+    declared or deleted per call. Calls are matched to replies by their
+    correlation id, which allows any number of calls to be outstanding at the
+    same time: publish them all with call_async() and collect the results
+    afterwards.
+
+    Like Publisher, the client runs the IOLoop of its connection only while
+    it waits for something, i.e. inside RpcFuture.result(). A timer fails the
+    calls whose deadline passes while the IOLoop runs, and call_async() fails
+    them too, so calls which are only followed with add_done_callback() time
+    out as well.
+
+    """
+
+    def __init__(self, amqp_url, exchange='', **kwargs):
+        """Create a new instance of the RpcClient class and connect to
+        RabbitMQ.
+
+        :param str amqp_url: The AMQP url to connect with
+        :param str exchange: Name of the exchange requests are published to.
+                It's default value is '' i.e. the default exchange, which routes
+                a request to the queue named by its routing key
+        :param float timeout: Default number of seconds a call waits for its
+                reply. It's default value is 30
+        :param reconnect_time: The number of seconds after which connection will
+                automatically restart if it accidently stops. Its default value
+                is 5 seconds.
+
+        """
+        self._connection = None
+        self._channel = None
+        self._closing = False
+        self._futures = {}
+        self._deadlines = []
+        # (deadline, timeout handle) of the timer expiring the earliest call
+        self._deadline_timer = None
+        self._waiting_for = None
+        self._LOGGER = logging.getLogger(__name__)
+        self._url = amqp_url
+        self.exchange = exchange
+        self.timeout = kwargs.get('timeout', 30)
+        self.reconnect_time = kwargs.get('reconnect_time', 5)
+        self.connect()
+        self._connection.ioloop.start()
+
+    def connect(self):
+        """Connect to RabbitMQ. When the connection is established, the
+        on_connection_open method will be invoked by pika.
+
+        """
+        self._LOGGER.info('Connecting to %s', self._url)
+        self._connection = pika.SelectConnection(pika.URLParameters(self._url),
+                                                 self.on_connection_open,
+                                                 self.on_connection_error,
+                                                 stop_ioloop_on_close=False)
+
+    def on_connection_open(self, unused_connection):
+        """Invoked by pika once the connection to RabbitMQ has been
+        established.
+
+        :type unused_connection: pika.SelectConnection
+
+        """
+        self._LOGGER.info('Connection opened')
+        self._connection.add_on_close_callback(self.on_connection_closed)
+        self._connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_error(self, connection, error):
+        self._LOGGER.warning('RpcClient: Connection failed, retrying in %d seconds',
+                             self.reconnect_time)
+        connection.add_timeout(self.reconnect_time, self.reconnect)
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        """Invoked by pika when the connection to RabbitMQ is closed. Fails
+        the pending calls and reconnects unless the client is being stopped.
+
+        :param pika.connection.Connection connection: The closed connection obj
+        :param int reply_code: The server provided reply_code if given
+        :param str reply_text: The server provided reply_text if given
+
+        """
+        self._channel = None
+        self.fail_pending('Connection closed: (%s) %s' % (reply_code, reply_text))
+        if self._closing:
+            self._connection.ioloop.stop()
+        else:
+            self._LOGGER.warning('Connection closed, reopening in %d seconds: (%s) %s',
+                                 self.reconnect_time, reply_code, reply_text)
+            self._connection.add_timeout(self.reconnect_time, self.reconnect)
+
+    def reconnect(self):
+        """Invoked by the IOLoop timer if the connection is closed. Stops the
+        IOLoop of the old connection and runs the new one until its reply
+        consumer is set up.
+
+        """
+        self._connection.ioloop.stop()
+        if not self._closing:
+            self.connect()
+            self._connection.ioloop.start()
+
+    def on_channel_open(self, channel):
+        """Invoked by pika when the channel has been opened. Starts consuming
+        replies with automatic acknowledgement, as direct reply-to requires,
+        and hands control back to the caller.
+
+        :param pika.channel.Channel channel: The channel object
+
+        """
+        self._LOGGER.info('Channel opened, consuming replies')
+        self._channel = channel
+        self._channel.add_on_close_callback(self.on_channel_closed)
+        self._channel.basic_consume(self.on_response, REPLY_TO, no_ack=True)
+        self._connection.ioloop.stop()
+
+    def on_channel_closed(self, channel, reply_code, reply_text):
+        """Invoked by pika when RabbitMQ closes the channel. The pending calls
+        can't get their replies any more; the connection is closed and
+        reopened.
+
+        :param pika.channel.Channel: The closed channel
+        :param int reply_code: The numeric reason the channel was closed
+        :param str reply_text: The text reason the channel was closed
+
+        """
+        self._LOGGER.warning('Channel was closed: (%s) %s', reply_code, reply_text)
+        self._channel = None
+        self.fail_pending('Channel closed: (%s) %s' % (reply_code, reply_text))
+        if not self._connection.is_closing and not self._connection.is_closed:
+            self._connection.close()
+
+    def call_async(self, routing_key, body, timeout=None, properties=None):
+        """Publish a request and return an RpcFuture for its reply without
+        waiting for it.
+
+        :param str routing_key: The routing key of the request, i.e. the name
+                of the server queue when using the default exchange
+        :param str body: The request body
+        :param float timeout: Seconds to wait for the reply. It's default value
+                is the timeout of the client
+        :param dict properties: Extra pika.BasicProperties fields for the request
+        :rtype: RpcFuture
+
+        """
+        self.expire_calls()
+        if not (self._channel and self._channel.is_open):
+            self._LOGGER.warning('Channel not available... reconnecting')
+            self.reconnect()
+        correlation_id = uuid.uuid4().hex
+        properties = dict(properties or {})
+        properties['reply_to'] = REPLY_TO
+        properties['correlation_id'] = correlation_id
+        self._channel.basic_publish(self.exchange, routing_key, body,
+                                    properties=pika.BasicProperties(**properties))
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        future = RpcFuture(self, correlation_id, deadline)
+        self._futures[correlation_id] = future
+        heapq.heappush(self._deadlines, (deadline, correlation_id))
+        self.schedule_expiry()
+        return future
+
+    def call(self, routing_key, body, timeout=None, properties=None):
+        """Publish a request and return the body of its reply. Takes the same
+        arguments as call_async().
+
+        """
+        return self.call_async(routing_key, body, timeout, properties).result()
+
+    def pending_calls(self):
+        """Return the number of calls waiting for their reply."""
+        return len(self._futures)
+
+    def on_response(self, unused_channel, basic_deliver, properties, body):
+        """Invoked by pika when a reply is delivered. Resolves the future of
+        the call with the same correlation id; replies to calls which already
+        timed out are dropped.
+
+        :param pika.channel.Channel unused_channel: The channel object
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param str|unicode body: The reply body
+
+        """
+        future = self._futures.pop(properties.correlation_id, None)
+        if future is None:
+            self._LOGGER.debug('Dropping reply to unknown call %s',
+                               properties.correlation_id)
+            return
+        error = (properties.headers or {}).get(ERROR_HEADER)
+        if error is not None:
+            future.set_exception(RpcError(error))
+        else:
+            future.set_result(body, properties)
+        if future is self._waiting_for:
+            self._connection.ioloop.stop()
+
+    def wait(self, future, timeout=None):
+        """Run the IOLoop until the future is done or its deadline (or the
+        given timeout) has passed. Calls whose deadline passed meanwhile fail
+        with RpcTimeout.
+
+        :param RpcFuture future: The future to wait for
+        :param float timeout: Seconds to wait at most. It's default value is
+                None i.e. until the deadline of the call
+
+        """
+        deadline = future.deadline
+        if timeout is not None:
+            deadline = min(deadline, time.time() + timeout)
+        while not future.done():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            timer = self._connection.add_timeout(remaining, self._connection.ioloop.stop)
+            self._waiting_for = future
+            try:
+                self._connection.ioloop.start()
+            finally:
+                self._waiting_for = None
+                self._connection.remove_timeout(timer)
+        self.expire_calls()
+        if not future.done():
+            raise RpcTimeout('No reply to call %s within the timeout' % future.correlation_id)
+
+    def expire_calls(self):
+        """Fail the calls whose deadline has passed with RpcTimeout."""
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, correlation_id = heapq.heappop(self._deadlines)
+            future = self._futures.pop(correlation_id, None)
+            if future is not None:
+                future.set_exception(RpcTimeout(
+                    'No reply to call %s within the timeout' % correlation_id))
+                if future is self._waiting_for:
+                    self._connection.ioloop.stop()
+
+    def schedule_expiry(self):
+        """Make sure a timer fires at the earliest deadline of the pending
+        calls.
+
+        """
+        if not self._deadlines:
+            return
+        deadline = self._deadlines[0][0]
+        if self._deadline_timer is not None:
+            if self._deadline_timer[0] <= deadline:
+                return
+            self._connection.remove_timeout(self._deadline_timer[1])
+        timer = self._connection.add_timeout(max(deadline - time.time(), 0),
+                                             self.on_deadline)
+        self._deadline_timer = (deadline, timer)
+
+    def on_deadline(self):
+        """Invoked by the IOLoop timer at the earliest deadline. Fails the
+        expired calls and schedules the timer for the next deadline.
+
+        """
+        self._deadline_timer = None
+        self.expire_calls()
+        self.schedule_expiry()
+
+    def fail_pending(self, reason):
+        """Fail every pending call with RpcError, since their replies can't
+        arrive any more.
+
+        :param str reason: The reason given in the RpcError
+
+        """
+        futures = list(self._futures.values())
+        self._futures = {}
+        self._deadlines = []
+        if self._deadline_timer is not None:
+            self._connection.remove_timeout(self._deadline_timer[1])
+            self._deadline_timer = None
+        for future in futures:
+            future.set_exception(RpcError(reason))
+        if self._waiting_for in futures:
+            self._connection.ioloop.stop()
+
+    def stop(self):
+        """Close the channel and the connection to RabbitMQ."""
+        self._LOGGER.info('Stopping')
+        self._closing = True
+        if self._connection and self._connection.is_open:
+            self._connection.close()
+            self._connection.ioloop.start()
+        self._LOGGER.info('Stopped')
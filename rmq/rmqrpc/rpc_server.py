@@ -0,0 +1,57 @@
+import pika
+
+from rmq.rmqreceiver.rabbitmq_receiver import Receiver
+from rmq.rmqrpc.rpc_client import ERROR_HEADER
+
+
+class RpcServer(Receiver):
+    """Receiver which answers the requests of RpcClient.
+
+    The return value of the handler is published to the reply_to address of
+    the request through the default exchange, with the correlation id of the
+    request. If the handler raises, the error is sent back in the
+    x-rpc-error header instead and the client raises RpcError.
+
+    """
+
+    def __init__(self, handler, amqp_url, exchange='', **kwargs):
+        """Create a new instance of the RpcServer class. Takes the same
+        optional arguments as Receiver.
+
+        :param method handler: The method to callback with every request, with
+                the signature handler(channel, method, properties, body). Its
+                return value is the body of the reply, None being sent as an
+                empty body
+        :param str amqp_url: The AMQP url to connect with
+        :param str exchange: Name of exchange. It's default value is '' i.e.
+                the default exchange, in which case clients use the queue name
+                as routing key and no binding is made
+
+        """
+        self.handler = handler
+        Receiver.__init__(self, self.on_request, amqp_url, exchange, **kwargs)
+
+    def on_request(self, channel, basic_deliver, properties, body):
+        """Consumer callback calling the handler and publishing its reply.
+
+        :param pika.channel.Channel channel: The channel object
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param str|unicode body: The request body
+
+        """
+        reply_properties = {'correlation_id': properties.correlation_id}
+        try:
+            response = self.handler(channel, basic_deliver, properties, body)
+            if response is None:
+                response = ''
+        except Exception as error:
+            self._LOGGER.exception('Handling request %s failed', properties.correlation_id)
+            response = ''
+            reply_properties['headers'] = {ERROR_HEADER: repr(error)}
+        if not properties.reply_to:
+            self._LOGGER.warning('Request %s has no reply_to, dropping the reply',
+                                 properties.correlation_id)
+            return
+        channel.basic_publish('', properties.reply_to, response,
+                              properties=pika.BasicProperties(**reply_properties))
@@ -0,0 +1,80 @@
+from rmq.rmqreceiver.rabbitmq_receiver import Receiver
+from rmq.rmqtraffic.trafficlog import TrafficWriter, properties_to_dict
+
+
+class TrafficRecorder(Receiver):
+    """Receiver which writes every delivery to a traffic log file, to be
+    replayed later with rmq.rmqtraffic.replay.
+
+    By default it consumes from a server named, exclusive queue bound to the
+    exchange with the binding key '#', i.e. it records a copy of the traffic without taking messages
+    away from anybody. To record the content of an existing queue without
+    acknowledging its messages, pass queue, ack_captured=False and
+    max_messages: RabbitMQ then delivers at most max_messages messages and
+    they go back to the queue when the recorder stops.
+
+    """
+
+    def __init__(self, path, amqp_url, exchange, **kwargs):
+        """Create a new instance of the TrafficRecorder class. Takes the same
+        optional arguments as Receiver, plus:
+
+        :param str path: Path of the traffic log file to write
+        :param str amqp_url: The AMQP url to connect with
+        :param str exchange: Name of exchange
+        :param list binding_keys: The list of binding keys to be used. It's
+                default value is ['#'] i.e. every message of a topic exchange
+        :param bool ack_captured: Acknowledge the recorded messages. It's
+                default value is True
+        :param int max_messages: Stop after recording this many messages.
+                Required if ack_captured is False. It's default value is None
+                i.e. record until stopped
+
+        """
+        self.ack_captured = kwargs.pop('ack_captured', True)
+        self.max_messages = kwargs.pop('max_messages', None)
+        kwargs.setdefault('binding_keys', ['#'])
+        if not self.ack_captured:
+            if not self.max_messages:
+                raise ValueError('max_messages is required when ack_captured is False')
+            kwargs['no_ack'] = False
+            kwargs['prefetch_count'] = self.max_messages
+        Receiver.__init__(self, self.record_message, amqp_url, exchange, **kwargs)
+        self._writer = TrafficWriter(path)
+
+    def record_message(self, unused_channel, basic_deliver, properties, body):
+        """Consumer callback writing the delivery to the traffic log.
+
+        :param pika.channel.Channel unused_channel: The channel object
+        :param pika.Spec.Basic.Deliver: basic_deliver method
+        :param pika.Spec.BasicProperties: properties
+        :param str|unicode body: The message body
+
+        """
+        if self.max_messages and self._writer.records >= self.max_messages:
+            return
+        self._writer.write(basic_deliver.routing_key,
+                           properties_to_dict(properties), body)
+        if self.max_messages and self._writer.records == self.max_messages:
+            self._LOGGER.info('Recorded %d messages, stopping', self._writer.records)
+            self.finish()
+
+    def acknowledge_message(self, delivery_tag):
+        """Acknowledge the message only if ack_captured is set."""
+        if self.ack_captured:
+            Receiver.acknowledge_message(self, delivery_tag)
+
+    def finish(self):
+        """Cancel the consumer from inside the IOLoop. Once RabbitMQ confirms,
+        the channel and connection are closed and run() returns.
+
+        """
+        self._closing = True
+        self.stop_consuming()
+
+    def run(self):
+        """Record deliveries until stopped, then close the traffic log."""
+        try:
+            Receiver.run(self)
+        finally:
+            self._writer.close()
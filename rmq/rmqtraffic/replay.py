@@ -0,0 +1,97 @@
+import sys
+import time
+import logging
+import argparse
+
+from rmq.rmqproducer.rabbitmq_producer import Publisher
+from rmq.rmqtraffic.trafficlog import TrafficReader
+
+LOGGER = logging.getLogger(__name__)
+
+# number of published messages between two progress log lines
+PROGRESS_INTERVAL = 10000
+
+
+def replay(path, publisher, speed=1.0, keep_message_ids=False):
+    """Publish the deliveries of a traffic log file with a Publisher,
+    reproducing the recorded inter-arrival times.
+
+    :param str path: Path of the traffic log file
+    :param Publisher publisher: The publisher to publish the messages with
+    :param float speed: Replay speed relative to the recording, e.g. 2 to
+            replay twice as fast. 0 or None publishes as fast as possible.
+            It's default value is 1.0
+    :param bool keep_message_ids: Publish the messages with their recorded
+            message_id. By default new ids are generated so that consumers
+            with a dedup_cache don't skip the replayed messages
+    :rtype: tuple
+    :return: The number of messages published and the seconds it took
+
+    """
+    reader = TrafficReader(path)
+    published = 0
+    started_at = time.time()
+    schedule = 0.0
+    LOGGER.info('Replaying %s at speed %s', path, speed or 'unlimited')
+    try:
+        for delay, routing_key, properties, body in reader:
+            if speed:
+                # sleep against the cumulative schedule so that errors don't add up
+                schedule += delay / speed
+                wait = started_at + schedule - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            if not keep_message_ids:
+                properties.pop('message_id', None)
+            publisher.publish_message(body, routing_key, properties)
+            published += 1
+            if published % PROGRESS_INTERVAL == 0:
+                LOGGER.info('Replayed %d messages in %.3f s', published,
+                            time.time() - started_at)
+        publisher.wait_for_confirmations()
+    except Exception as error:
+        LOGGER.error('Replay of %s failed after %d messages: %r', path, published, error)
+        raise
+    finally:
+        reader.close()
+    elapsed = time.time() - started_at
+    LOGGER.info('Replayed %d messages from %s in %.3f s', published, path, elapsed)
+    return published, elapsed
+
+
+def main(argv=None):
+    """Command line entry point: replay a traffic log against a broker and
+    report the achieved throughput.
+
+    """
+    parser = argparse.ArgumentParser(description='Replay a RabbitMQ traffic log')
+    parser.add_argument('path', help='traffic log file written by TrafficRecorder')
+    parser.add_argument('amqp_url', help='AMQP url of the target broker')
+    parser.add_argument('exchange', help='exchange to publish to')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed, e.g. 10 for 10x; 0 for as fast as possible')
+    parser.add_argument('--exchange-type', default='topic')
+    parser.add_argument('--max-inflight', type=int, default=1,
+                        help='unconfirmed messages allowed at a time')
+    parser.add_argument('--no-confirm', action='store_true',
+                        help='publish without delivery confirmations')
+    parser.add_argument('--keep-message-ids', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    publisher = Publisher(args.amqp_url, args.exchange,
+                          exchange_type=args.exchange_type,
+                          delivery_confirmation=not args.no_confirm,
+                          max_inflight_messages=args.max_inflight)
+    try:
+        published, elapsed = replay(args.path, publisher, args.speed,
+                                    args.keep_message_ids)
+    finally:
+        publisher.stop()
+    rate = published / elapsed if elapsed else float('inf')
+    sys.stdout.write('Published %d messages in %.3f s (%.1f msg/s)\n'
+                     % (published, elapsed, rate))
+
+
+if __name__ == '__main__':
+    main()
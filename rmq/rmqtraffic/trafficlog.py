@@ -0,0 +1,123 @@
+import json
+import time
+import struct
+
+MAGIC = b'RMQTRAF1'
+RECORD_HEADER = struct.Struct('>dHII')
+
+PROPERTY_NAMES = ('content_type', 'content_encoding', 'headers', 'delivery_mode',
+                  'priority', 'correlation_id', 'reply_to', 'expiration',
+                  'message_id', 'timestamp', 'type', 'user_id', 'app_id',
+                  'cluster_id')
+
+
+def properties_to_dict(properties):
+    """Return the properties which are set on a pika.BasicProperties object as
+    a dictionary.
+
+    """
+    result = {}
+    for name in PROPERTY_NAMES:
+        value = getattr(properties, name, None)
+        if value is not None:
+            result[name] = value
+    return result
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return str(value)
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+class TrafficWriter(object):
+    """Writes deliveries to a traffic log file.
+
+    The file starts with an 8 byte magic string followed by one record per
+    delivery: a fixed size header holding the seconds elapsed since the
+    previous delivery and the lengths of the routing key, the properties and
+    the body, then the routing key, the properties encoded as JSON and the
+    body. Header values JSON can't represent (e.g. bytes, datetime) are
+    stored as strings.
+
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: Path of the traffic log file to create
+
+        """
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._last_timestamp = None
+        self.records = 0
+
+    def write(self, routing_key, properties, body, timestamp=None):
+        """Append a delivery to the log.
+
+        :param str routing_key: The routing key of the delivery
+        :param dict properties: The message properties, see properties_to_dict()
+        :param bytes body: The message body
+        :param float timestamp: Arrival time of the delivery. It's default value
+                is the current time
+
+        """
+        timestamp = timestamp or time.time()
+        if self._last_timestamp is None:
+            delay = 0.0
+        else:
+            delay = max(timestamp - self._last_timestamp, 0.0)
+        self._last_timestamp = timestamp
+        routing_key = _to_bytes(routing_key or '')
+        encoded_properties = _to_bytes(json.dumps(properties, default=_json_default))
+        body = _to_bytes(body)
+        self._file.write(RECORD_HEADER.pack(delay, len(routing_key),
+                                            len(encoded_properties), len(body)))
+        self._file.write(routing_key)
+        self._file.write(encoded_properties)
+        self._file.write(body)
+        self.records += 1
+
+    def close(self):
+        """Flush and close the log file."""
+        self._file.close()
+
+
+class TrafficReader(object):
+    """Iterates over the deliveries of a traffic log file written by
+    TrafficWriter, yielding (delay, routing_key, properties, body) tuples where
+    delay is the number of seconds since the previous delivery.
+
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: Path of the traffic log file to read
+
+        """
+        self._file = open(path, 'rb')
+        if self._file.read(len(MAGIC)) != MAGIC:
+            self._file.close()
+            raise ValueError('%s is not a traffic log file' % path)
+
+    def __iter__(self):
+        while True:
+            header = self._file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            delay, key_length, properties_length, body_length = \
+                RECORD_HEADER.unpack(header)
+            routing_key = self._file.read(key_length).decode('utf-8')
+            properties = json.loads(self._file.read(properties_length).decode('utf-8'))
+            body = self._file.read(body_length)
+            yield delay, routing_key, properties, body
+
+    def close(self):
+        """Close the log file."""
+        self._file.close()
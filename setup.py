@@ -12,8 +12,12 @@ setup(name='rmq-pub-sub',
       author='Rahul Kumar and Bipul Karnani',
       author_email='rahul.kumar@housing.com',
       license='MIT',
-      packages=['rmq', 'rmq.rmqproducer', 'rmq.rmqreceiver'],
+      packages=['rmq', 'rmq.rmqproducer', 'rmq.rmqreceiver', 'rmq.rmqtraffic',
+                'rmq.rmqrpc', 'rmq.rmqpipeline'],
       install_requires=[
           'pika',
       ],
+      entry_points={
+          'console_scripts': ['rmq-replay=rmq.rmqtraffic.replay:main'],
+      },
       zip_safe=False)
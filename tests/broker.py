@@ -0,0 +1,339 @@
+"""In process stand-in for a RabbitMQ broker and the pika SelectConnection
+API used by the Receiver, so that the consumer state machines can be driven
+without a server.
+
+Callbacks of RPC commands run synchronously. Messages are only delivered
+when the test calls Broker.deliver(), and publisher confirms are only sent
+when it calls FakeChannel.confirm().
+
+"""
+import copy
+from collections import deque
+
+import pika
+from pika import spec
+
+
+class Namespace(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _frame(method):
+    return Namespace(method=method)
+
+
+def topic_matches(pattern, routing_key):
+    return _words_match(pattern.split('.'), routing_key.split('.'))
+
+
+def _words_match(pattern, words):
+    if not pattern:
+        return not words
+    if pattern[0] == '#':
+        return any(_words_match(pattern[1:], words[skip:])
+                   for skip in range(len(words) + 1))
+    if not words:
+        return False
+    return pattern[0] in ('*', words[0]) and _words_match(pattern[1:], words[1:])
+
+
+class FakeQueue(object):
+
+    def __init__(self, name, durable, exclusive, arguments):
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.arguments = arguments or {}
+        self.stream = self.arguments.get('x-queue-type') == 'stream'
+        # (exchange, routing_key, properties, body); streams never drop
+        # messages
+        self.messages = deque()
+        self.consumers = []
+
+
+class Broker(object):
+
+    def __init__(self):
+        self.exchanges = {}
+        self.queues = {}
+        self.bindings = []
+        self.channels = []
+        self._queue_number = 0
+
+    def connect(self):
+        return FakeConnection(self)
+
+    def declare_queue(self, name, durable=True, exclusive=False, arguments=None):
+        if not name:
+            self._queue_number += 1
+            name = 'amq.gen-%d' % self._queue_number
+        if name not in self.queues:
+            self.queues[name] = FakeQueue(name, durable, exclusive, arguments)
+        return self.queues[name]
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        properties = properties or pika.BasicProperties()
+        if not exchange:
+            targets = [routing_key] if routing_key in self.queues else []
+        else:
+            targets = [queue for bound_exchange, queue, key in self.bindings
+                       if bound_exchange == exchange and
+                       (self.exchanges.get(exchange) != 'topic' or
+                        topic_matches(key, routing_key)) and
+                       (self.exchanges.get(exchange) != 'direct' or key == routing_key)]
+        for name in targets:
+            self.queues[name].messages.append((exchange, routing_key, properties, body))
+
+    def expire(self, name):
+        """Dead letter the messages of a queue as if their TTL had passed."""
+        queue = self.queues[name]
+        while queue.messages:
+            exchange, routing_key, properties, body = queue.messages.popleft()
+            self.publish(queue.arguments.get('x-dead-letter-exchange', ''),
+                         queue.arguments.get('x-dead-letter-routing-key', routing_key),
+                         body, properties)
+
+    def deliver(self):
+        """Push the ready messages to the consumers, within their prefetch
+        limits. Returns the number of messages delivered.
+
+        """
+        delivered = 0
+        for queue in list(self.queues.values()):
+            for consumer in list(queue.consumers):
+                delivered += consumer.pump()
+        return delivered
+
+
+class Consumer(object):
+
+    def __init__(self, channel, queue, callback, no_ack, arguments):
+        self.channel = channel
+        self.queue = queue
+        self.callback = callback
+        self.no_ack = no_ack
+        self.tag = 'ctag%d' % id(self)
+        self.offset = None
+        if queue.stream:
+            offset = (arguments or {}).get('x-stream-offset', 'next')
+            if offset == 'first':
+                self.offset = 0
+            elif offset == 'last':
+                self.offset = max(len(queue.messages) - 1, 0)
+            elif offset == 'next':
+                self.offset = len(queue.messages)
+            else:
+                self.offset = offset
+
+    def pump(self):
+        delivered = 0
+        while self.channel.is_open and (
+                self.no_ack or not self.channel.prefetch_count or
+                len(self.channel.unacked) < self.channel.prefetch_count):
+            if self.queue.stream:
+                if self.offset >= len(self.queue.messages):
+                    break
+                exchange, routing_key, properties, body = self.queue.messages[self.offset]
+                properties = copy.copy(properties)
+                properties.headers = dict(properties.headers or {})
+                properties.headers['x-stream-offset'] = self.offset
+                self.offset += 1
+            else:
+                if not self.queue.messages:
+                    break
+                exchange, routing_key, properties, body = self.queue.messages.popleft()
+            self.channel.delivery_tag += 1
+            method = spec.Basic.Deliver(self.tag, self.channel.delivery_tag, False,
+                                        exchange, routing_key)
+            if not self.no_ack:
+                self.channel.unacked[method.delivery_tag] = (
+                    self.queue, exchange, routing_key, properties, body)
+            self.callback(self.channel, method, properties, body)
+            delivered += 1
+        return delivered
+
+
+class FakeChannel(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self.prefetch_count = 0
+        self.delivery_tag = 0
+        self.unacked = {}
+        self.acked = []
+        self.nacked = []
+        self.published = []
+        self.consumers = {}
+        self.confirm_callback = None
+        self.unconfirmed = []
+        self.publish_number = 0
+        self.close_callbacks = []
+        self.cancel_callbacks = []
+        self.declared_queue = None
+        self.channel_number = len(connection.channels) + 1
+
+    def __int__(self):
+        return self.channel_number
+
+    def add_on_close_callback(self, callback):
+        self.close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        self.cancel_callbacks.append(callback)
+
+    def exchange_declare(self, callback, exchange, exchange_type, **kwargs):
+        self.broker.exchanges[exchange] = exchange_type
+        callback(_frame(spec.Exchange.DeclareOk()))
+
+    def queue_declare(self, callback, queue='', passive=False, durable=False,
+                      exclusive=False, arguments=None):
+        if passive:
+            fake_queue = self.broker.queues[queue]
+        else:
+            fake_queue = self.broker.declare_queue(queue, durable, exclusive, arguments)
+            self.declared_queue = fake_queue.name
+        callback(_frame(spec.Queue.DeclareOk(fake_queue.name, len(fake_queue.messages),
+                                             len(fake_queue.consumers))))
+
+    def queue_bind(self, callback, queue, exchange, routing_key=None):
+        if not queue:
+            queue = self.declared_queue
+        self.broker.bindings.append((exchange, queue, routing_key))
+        callback(_frame(spec.Queue.BindOk()))
+
+    def basic_qos(self, prefetch_count=0):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, callback, queue, no_ack=False, arguments=None):
+        consumer = Consumer(self, self.broker.queues[queue or self.declared_queue],
+                            callback, no_ack, arguments)
+        consumer.arguments = arguments
+        consumer.queue.consumers.append(consumer)
+        self.consumers[consumer.tag] = consumer
+        return consumer.tag
+
+    def basic_cancel(self, callback, consumer_tag):
+        consumer = self.consumers.pop(consumer_tag)
+        consumer.queue.consumers.remove(consumer)
+        callback(_frame(spec.Basic.CancelOk(consumer_tag)))
+
+    def _settle(self, delivery_tag, multiple):
+        if multiple:
+            tags = [tag for tag in sorted(self.unacked) if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        return [(tag, self.unacked.pop(tag)) for tag in tags]
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        for tag, _ in self._settle(delivery_tag, multiple):
+            self.acked.append(tag)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        for tag, (queue, exchange, routing_key, properties, body) in \
+                self._settle(delivery_tag, multiple):
+            self.nacked.append(tag)
+            if requeue and not queue.stream:
+                queue.messages.appendleft((exchange, routing_key, properties, body))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((exchange, routing_key, body, properties))
+        self.broker.publish(exchange, routing_key, body, properties)
+        if self.confirm_callback is not None:
+            self.publish_number += 1
+            self.unconfirmed.append(self.publish_number)
+
+    def confirm_delivery(self, callback):
+        self.confirm_callback = callback
+
+    def confirm(self, count=None, nack=False, multiple=False):
+        """Confirm (or reject) the oldest unconfirmed publishes."""
+        count = len(self.unconfirmed) if count is None else count
+        confirmed, self.unconfirmed = self.unconfirmed[:count], self.unconfirmed[count:]
+        method = spec.Basic.Nack if nack else spec.Basic.Ack
+        if multiple and confirmed:
+            self.confirm_callback(_frame(method(confirmed[-1], multiple=True)))
+            return
+        for publish_number in confirmed:
+            self.confirm_callback(_frame(method(publish_number)))
+
+    def close(self):
+        """Close the channel; unacknowledged messages go back to their queues."""
+        if not self.is_open:
+            return
+        self.is_open = False
+        for consumer in list(self.consumers.values()):
+            consumer.queue.consumers.remove(consumer)
+        self.consumers = {}
+        self.basic_nack(max(self.unacked) if self.unacked else 0, multiple=True,
+                        requeue=True)
+        for callback in self.close_callbacks:
+            callback(self, 200, 'Normal shutdown')
+
+
+class FakeIOLoop(object):
+
+    def __init__(self):
+        self.handlers = {}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def add_handler(self, fd, handler, events):
+        self.handlers[fd] = handler
+
+    def remove_handler(self, fd):
+        self.handlers.pop(fd, None)
+
+
+class FakeConnection(object):
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.ioloop = FakeIOLoop()
+        self.timeouts = []
+        self.channels = []
+        self.is_open = True
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def channel(self, on_open_callback=None):
+        channel = FakeChannel(self)
+        self.channels.append(channel)
+        self.broker.channels.append(channel)
+        if on_open_callback is not None:
+            on_open_callback(channel)
+        return channel
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+        return callback
+
+    def remove_timeout(self, timeout):
+        self.timeouts = [entry for entry in self.timeouts if entry[1] is not timeout]
+
+    def run_timeouts(self):
+        """Run the callbacks scheduled so far, as if their time had come."""
+        timeouts, self.timeouts = self.timeouts, []
+        for _, callback in timeouts:
+            callback()
+
+    def close(self):
+        self.is_open = False
+
+
+def start(receiver, broker):
+    """Open a connection to the broker for the receiver, as Receiver.run()
+    does, without blocking.
+
+    """
+    receiver._connection = broker.connect()
+    receiver.on_connection_open(receiver._connection)
+    return receiver._connection
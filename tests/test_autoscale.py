@@ -0,0 +1,131 @@
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from rmq.rmqreceiver.autoscale import BacklogMonitor
+from rmq.rmqreceiver.rabbitmq_receiver import Receiver
+
+from tests import broker as fake
+
+
+class FakePool(object):
+
+    def __init__(self, processes):
+        self.processes = processes
+
+    def resize(self, processes):
+        self.processes = processes
+
+
+class BacklogMonitorTest(unittest.TestCase):
+
+    def test_scales_consumers(self):
+        calls = []
+        monitor = BacklogMonitor(target_drain_time=60,
+                                 scale_hook=lambda desired, stats: calls.append(desired))
+        # 4 consumers handling 100 messages/s each, the backlog stays at 6000
+        monitor.update(6000, 4, 0, now=0)
+        monitor.update(6000, 4, 1000, now=10)
+        self.assertEqual(monitor.unit_rate, 100)
+        self.assertEqual(monitor.drain_rate, 400)
+        self.assertEqual(monitor.arrival_rate, 400)
+        self.assertEqual(monitor.desired, 5)
+        self.assertEqual(calls, [5])
+
+    def test_resizes_pool(self):
+        pool = FakePool(2)
+        monitor = BacklogMonitor(target_drain_time=10, process_pool=pool,
+                                 max_consumers=8)
+        # the pool handles 100 messages/s and the backlog grows by 50/s
+        monitor.update(1000, 1, 0, now=0)
+        monitor.update(1500, 1, 1000, now=10)
+        self.assertEqual(monitor.unit_rate, 50)
+        self.assertEqual(monitor.drain_rate, 100)
+        self.assertEqual(monitor.arrival_rate, 150)
+        # (150 + 1500 / 10) / 50 = 6
+        self.assertEqual(pool.processes, 6)
+
+    def test_shrinks_once_backlog_is_drained(self):
+        calls = []
+        monitor = BacklogMonitor(smoothing=1,
+                                 scale_hook=lambda desired, stats: calls.append(desired))
+        # saturated: 10 consumers handling 100 messages/s each
+        monitor.update(60000, 10, 0, now=0)
+        monitor.update(60000, 10, 1000, now=10)
+        self.assertEqual(monitor.unit_rate, 100)
+        self.assertEqual(calls, [20])
+        # the backlog is gone and 50 messages/s arrive, i.e. 5/s per consumer
+        monitor.update(0, 10, 1050, now=20)
+        monitor.update(0, 10, 1100, now=30)
+        # the consumers weren't saturated, so the capacity stays 100/s
+        self.assertEqual(monitor.unit_rate, 100)
+        self.assertEqual(monitor.arrival_rate, 50)
+        self.assertEqual(calls[-1], 1)
+
+    def test_pool_counts_other_consumers(self):
+        pool = FakePool(4)
+        monitor = BacklogMonitor(target_drain_time=10, process_pool=pool)
+        # 2 Receivers each with 4 workers handling 25 messages/s per worker
+        monitor.update(1000, 2, 0, now=0)
+        monitor.update(1000, 2, 1000, now=10)
+        self.assertEqual(monitor.unit_rate, 25)
+        self.assertEqual(monitor.drain_rate, 200)
+        self.assertEqual(monitor.arrival_rate, 200)
+        # (200 + 1000 / 10) / 2 consumers / 25 = 6 workers
+        self.assertEqual(pool.processes, 6)
+
+    def test_bounds_and_unknown_rate(self):
+        monitor = BacklogMonitor(min_consumers=2, max_consumers=3)
+        monitor.update(10, 1, 0, now=0)
+        self.assertIsNone(monitor.drain_time())
+        monitor.update(10, 1, 0, now=10)
+        self.assertEqual(monitor.desired_consumers(), 2)
+        monitor.update(100000, 1, 1000, now=20)
+        self.assertEqual(monitor.desired_consumers(), 3)
+
+    def test_drain_time(self):
+        monitor = BacklogMonitor(smoothing=1)
+        monitor.update(1000, 1, 0, now=0)
+        monitor.update(900, 1, 200, now=10)
+        # draining 20/s while 10/s arrive
+        self.assertEqual(monitor.drain_time(), 90)
+        monitor.update(1000, 1, 200, now=20)
+        self.assertEqual(monitor.drain_time(), float('inf'))
+
+
+class BacklogReceiverTest(unittest.TestCase):
+
+    def test_polls_queue_on_monitor_channel(self):
+        broker = fake.Broker()
+        calls = []
+        monitor = BacklogMonitor(interval=10, target_drain_time=60,
+                                 scale_hook=lambda desired, stats: calls.append(desired))
+        receiver = Receiver(lambda *args: None, 'amqp://', '', queue='work',
+                            backlog_monitor=monitor)
+        broker.declare_queue('work')
+        for _ in range(30):
+            broker.publish('', 'work', b'body')
+        with mock.patch('time.time', return_value=0):
+            connection = fake.start(receiver, broker)
+        self.assertIsNot(receiver._monitor_channel, receiver._channel)
+        self.assertEqual((monitor.backlog, monitor.consumers), (30, 1))
+        [(delay, poll)] = connection.timeouts
+        self.assertEqual(delay, 10)
+        broker.deliver()
+        for _ in range(60):
+            broker.publish('', 'work', b'body')
+        with mock.patch('time.time', return_value=10):
+            connection.run_timeouts()
+        # 3 messages/s processed while saturated and 6/s arriving, with 60
+        # messages to drain in 60 s: (6 + 1) / 3
+        self.assertEqual(monitor.unit_rate, 3)
+        self.assertEqual(monitor.arrival_rate, 6)
+        self.assertEqual(calls, [3])
+        self.assertEqual(len(connection.timeouts), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import io
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pika
+from pika import spec
+
+from rmq.rmqproducer import chunking
+from rmq.rmqreceiver.rabbitmq_receiver import Receiver
+from rmq.rmqreceiver.reassembly import ChunkReassembler
+from rmq.rmqreceiver.retry import RetryPolicy
+
+from tests import broker as fake
+
+
+class IterChunksTest(unittest.TestCase):
+
+    def test_file(self):
+        chunks = list(chunking.iter_chunks(io.BytesIO(b'abcdefg'), chunk_size=3))
+        self.assertEqual(chunks, [(0, b'abc', False), (1, b'def', False),
+                                  (2, b'g', True)])
+
+    def test_iterator_skips_empty_pieces(self):
+        chunks = list(chunking.iter_chunks(iter([b'ab', b'', b'cd'])))
+        self.assertEqual(chunks, [(0, b'ab', False), (1, b'cd', True)])
+
+    def test_empty_payload(self):
+        self.assertEqual(list(chunking.iter_chunks(io.BytesIO(b''))), [(0, b'', True)])
+
+
+class ChunkReassemblerTest(unittest.TestCase):
+
+    def test_reorders_and_drops_duplicates(self):
+        reassembler = ChunkReassembler()
+        self.assertEqual(reassembler.feed('t', 1, False, b'b'), [])
+        self.assertEqual(reassembler.feed('t', 1, False, b'b'), [])
+        self.assertEqual(reassembler.feed('t', 0, False, b'a'),
+                         [(b'a', False), (b'b', False)])
+        self.assertEqual(reassembler.feed('t', 0, False, b'a'), [])
+        self.assertEqual(reassembler.feed('t', 2, True, b'c'), [(b'c', True)])
+
+    def test_spool(self):
+        reassembler = ChunkReassembler(spool_max_size=2)
+        self.assertIsNone(reassembler.spool('t', 1, True, b'def'))
+        payload = reassembler.spool('t', 0, False, b'abc')
+        self.assertEqual(payload.read(), b'abcdef')
+        payload.close()
+
+    def test_too_many_pending_chunks(self):
+        discarded = []
+        reassembler = ChunkReassembler(max_pending_chunks=2,
+                                       discard_callback=discarded.append)
+        for sequence_number in (1, 2, 3):
+            reassembler.feed('t', sequence_number, False, b'x')
+        self.assertEqual(discarded, ['t'])
+
+    def test_timeout(self):
+        discarded = []
+        with mock.patch('time.time', return_value=100):
+            reassembler = ChunkReassembler(transfer_timeout=10,
+                                           discard_callback=discarded.append)
+            reassembler.feed('t', 1, False, b'x')
+        with mock.patch('time.time', return_value=120):
+            reassembler.feed('u', 0, True, b'y')
+        self.assertEqual(discarded, ['t'])
+
+
+class TransferAcknowledgementTest(unittest.TestCase):
+
+    def deliver(self, receiver, delivery_tag, sequence_number, last, body):
+        method = mock.Mock(delivery_tag=delivery_tag, routing_key='files')
+        properties = mock.Mock(message_id='t.%d' % sequence_number, headers={
+            chunking.TRANSFER_ID_HEADER: 't',
+            chunking.CHUNK_SEQ_HEADER: sequence_number,
+            chunking.CHUNK_LAST_HEADER: last})
+        receiver.on_message(receiver._channel, method, properties, body)
+
+    def receiver(self, transfer_callback, **kwargs):
+        receiver = Receiver(None, 'amqp://', 'exchange', queue='files',
+                            transfer_callback=transfer_callback, **kwargs)
+        receiver._channel = mock.Mock()
+        return receiver
+
+    def acked(self, receiver):
+        return [call[0][0] for call in receiver._channel.basic_ack.call_args_list]
+
+    def test_chunks_acknowledged_after_callback(self):
+        payloads = []
+        receiver = self.receiver(lambda channel, method, properties, payload:
+                                 payloads.append(payload.read()))
+        self.deliver(receiver, 1, 0, False, b'ab')
+        self.deliver(receiver, 2, 0, False, b'ab')
+        self.assertEqual(self.acked(receiver), [])
+        self.deliver(receiver, 3, 1, True, b'cd')
+        self.assertEqual(payloads, [b'abcd'])
+        self.assertEqual(self.acked(receiver), [1, 2, 3])
+
+    def test_failed_callback_leaves_chunks_unacknowledged(self):
+        def fail(channel, method, properties, payload):
+            raise IOError('disk full')
+        receiver = self.receiver(fail)
+        self.deliver(receiver, 1, 0, False, b'ab')
+        self.assertRaises(IOError, self.deliver, receiver, 2, 1, True, b'cd')
+        self.assertEqual(self.acked(receiver), [])
+
+    def test_failed_callback_retries_every_chunk(self):
+        def fail(channel, method, properties, payload):
+            raise IOError('disk full')
+        receiver = self.receiver(fail, retry_policy=RetryPolicy())
+        self.deliver(receiver, 1, 0, False, b'ab')
+        self.deliver(receiver, 2, 1, True, b'cd')
+        published = [(call[0][1], call[0][2])
+                     for call in receiver._channel.basic_publish.call_args_list]
+        self.assertEqual(published, [('files.retry.1000', b'ab'),
+                                     ('files.retry.1000', b'cd')])
+        self.assertEqual(self.acked(receiver), [])
+        receiver.on_delivery_confirmation(mock.Mock(method=spec.Basic.Ack(1)))
+        self.assertEqual(self.acked(receiver), [])
+        receiver.on_delivery_confirmation(mock.Mock(method=spec.Basic.Ack(2)))
+        self.assertEqual(self.acked(receiver), [1, 2])
+
+    def test_chunk_callback_with_retry_policy(self):
+        self.assertRaises(ValueError, Receiver, None, 'amqp://', 'exchange',
+                          queue='files', chunk_callback=mock.Mock(),
+                          retry_policy=RetryPolicy())
+
+
+class TransferWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = fake.Broker()
+        self.payloads = []
+
+    def transfer_callback(self, channel, method, properties, payload):
+        self.payloads.append(payload.read())
+
+    def receiver(self, **kwargs):
+        receiver = Receiver(None, 'amqp://', '', queue='files',
+                            transfer_callback=self.transfer_callback, **kwargs)
+        connection = fake.start(receiver, self.broker)
+        return receiver, connection
+
+    def publish(self, sequence_number, last, body):
+        self.broker.publish('', 'files', body, pika.BasicProperties(headers={
+            chunking.TRANSFER_ID_HEADER: 't',
+            chunking.CHUNK_SEQ_HEADER: sequence_number,
+            chunking.CHUNK_LAST_HEADER: last}))
+
+    def test_transfer_larger_than_prefetch_window(self):
+        receiver, _ = self.receiver(prefetch_count=2)
+        self.publish(0, False, b'ab')
+        self.publish(1, False, b'cd')
+        self.publish(2, True, b'ef')
+        self.broker.deliver()
+        self.assertEqual(self.payloads, [b'abcdef'])
+        self.assertEqual(receiver._channel.acked, [1, 2, 3])
+        self.assertEqual(receiver._channel.unacked, {})
+
+    def test_timed_out_transfer_is_requeued(self):
+        with mock.patch('time.time', return_value=100):
+            receiver, connection = self.receiver(transfer_timeout=10)
+            self.publish(1, True, b'cd')
+            self.broker.deliver()
+        [(delay, expire)] = connection.timeouts
+        self.assertEqual(delay, 1)
+        with mock.patch('time.time', return_value=120):
+            connection.run_timeouts()
+        self.assertEqual(receiver._channel.nacked, [1])
+        self.assertEqual(len(self.broker.queues['files'].messages), 1)
+        self.assertEqual(len(connection.timeouts), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
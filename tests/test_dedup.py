@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from rmq.rmqreceiver.dedup import MessageIdCache, MmapMessageIdCache
+
+
+class MessageIdCacheTest(unittest.TestCase):
+
+    def test_seen_after_add(self):
+        cache = MessageIdCache()
+        self.assertFalse(cache.seen('a'))
+        cache.add('a')
+        self.assertTrue(cache.seen('a'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1,
+                                         'hit_rate': 0.5, 'size': 1})
+
+    def test_evicts_least_recently_used(self):
+        cache = MessageIdCache(max_size=2)
+        cache.add('a')
+        cache.add('b')
+        cache.seen('a')
+        cache.add('c')
+        self.assertTrue(cache.seen('a'))
+        self.assertFalse(cache.seen('b'))
+        self.assertTrue(cache.seen('c'))
+
+    def test_seen_restarts_ttl(self):
+        cache = MessageIdCache(ttl=10)
+        with mock.patch('time.time', return_value=100):
+            cache.add('a')
+            cache.add('b')
+        with mock.patch('time.time', return_value=105):
+            self.assertTrue(cache.seen('a'))
+        with mock.patch('time.time', return_value=112):
+            cache.add('c')
+        # b expired while a was refreshed by the lookup at 105
+        self.assertEqual(list(cache._entries), ['a', 'c'])
+
+    def test_sweep_removes_expired_behind_refreshed_entry(self):
+        cache = MessageIdCache(ttl=10)
+        with mock.patch('time.time', return_value=100):
+            cache.add('a')
+            cache.add('b')
+        with mock.patch('time.time', return_value=101):
+            cache.seen('a')
+        with mock.patch('time.time', return_value=120):
+            cache.add('c')
+        self.assertEqual(list(cache._entries), ['c'])
+
+
+class MmapMessageIdCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dedup')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_survives_reopen(self):
+        cache = MmapMessageIdCache(self.path, slots=64)
+        cache.add('a')
+        cache.add('b')
+        cache.close()
+        cache = MmapMessageIdCache(self.path, slots=64)
+        self.assertTrue(cache.seen('a'))
+        self.assertFalse(cache.seen('c'))
+        self.assertEqual(len(cache), 2)
+        cache.close()
+
+    def test_reinitialised_with_other_slot_count(self):
+        cache = MmapMessageIdCache(self.path, slots=64)
+        cache.add('a')
+        cache.close()
+        cache = MmapMessageIdCache(self.path, slots=128)
+        self.assertFalse(cache.seen('a'))
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+    def test_len_counts_occupied_slots(self):
+        cache = MmapMessageIdCache(self.path, slots=4, probe=4)
+        for message_id in ('a', 'b', 'a', 'c', 'd', 'e', 'f'):
+            cache.add(message_id)
+        self.assertEqual(len(cache), 4)
+        cache.close()
+
+    def test_add_updates_existing_slot_behind_expired_one(self):
+        cache = MmapMessageIdCache(self.path, slots=8, ttl=10, probe=8)
+        start = cache._fingerprint('a') % cache.slots
+        other = next(message_id for message_id in ('b%d' % number for number in range(1000))
+                     if cache._fingerprint(message_id) % cache.slots == start)
+        with mock.patch('time.time', return_value=100):
+            cache.add('a')
+        with mock.patch('time.time', return_value=105):
+            cache.add(other)
+        with mock.patch('time.time', return_value=112):
+            # a expired, other is still in the slot after it
+            cache.add(other)
+        self.assertEqual(len(cache), 2)
+        keys = [cache._read(index)[0] for index in range(cache.slots)]
+        self.assertEqual(keys.count(cache._fingerprint(other)), 1)
+        cache.close()
+
+    def test_ttl(self):
+        cache = MmapMessageIdCache(self.path, slots=64, ttl=10)
+        with mock.patch('time.time', return_value=100):
+            cache.add('a')
+        with mock.patch('time.time', return_value=105):
+            self.assertTrue(cache.seen('a'))
+        with mock.patch('time.time', return_value=114):
+            self.assertTrue(cache.seen('a'))
+        with mock.patch('time.time', return_value=125):
+            self.assertFalse(cache.seen('a'))
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+
+import pika
+
+from rmq.rmqreceiver.dispatch import TopicDispatcher
+from rmq.rmqreceiver.rabbitmq_receiver import Receiver
+from rmq.rmqreceiver.retry import RetryPolicy
+
+from tests import broker as fake
+
+
+def first(*args):
+    pass
+
+
+def second(*args):
+    pass
+
+
+def third(*args):
+    pass
+
+
+class TopicDispatcherTest(unittest.TestCase):
+
+    def test_exact_and_star(self):
+        dispatcher = TopicDispatcher()
+        dispatcher.add('order.created', first)
+        dispatcher.add('order.*', second)
+        self.assertEqual(dispatcher.match('order.created'), (first, second))
+        self.assertEqual(dispatcher.match('order.paid'), (second,))
+        self.assertEqual(dispatcher.match('order'), ())
+        self.assertEqual(dispatcher.match('order.paid.late'), ())
+
+    def test_hash_matches_zero_or_more_words(self):
+        dispatcher = TopicDispatcher()
+        dispatcher.add('audit.#', first)
+        dispatcher.add('#.error', second)
+        dispatcher.add('#', third)
+        self.assertEqual(dispatcher.match('audit'), (first, third))
+        self.assertEqual(dispatcher.match('audit.user.login'), (first, third))
+        self.assertEqual(dispatcher.match('db.error'), (second, third))
+        self.assertEqual(dispatcher.match('audit.error'), (first, second, third))
+        self.assertEqual(dispatcher.match('error'), (second, third))
+
+    def test_registration_order_without_duplicates(self):
+        dispatcher = TopicDispatcher()
+        dispatcher.add('a.#', second)
+        dispatcher.add('a.b', first)
+        dispatcher.add('*.b', second)
+        self.assertEqual(dispatcher.match('a.b'), (second, first))
+        self.assertEqual(dispatcher.patterns(), ['a.#', 'a.b', '*.b'])
+        self.assertEqual(len(dispatcher), 3)
+
+    def test_cache_is_bounded_and_invalidated(self):
+        dispatcher = TopicDispatcher(cache_size=2)
+        dispatcher.add('a.*', first)
+        for routing_key in ('a.1', 'a.2', 'a.3'):
+            dispatcher.match(routing_key)
+        self.assertEqual(list(dispatcher._cache), ['a.2', 'a.3'])
+        dispatcher.add('a.3', second)
+        self.assertEqual(dispatcher.match('a.3'), (first, second))
+
+    def test_cache_disabled(self):
+        dispatcher = TopicDispatcher(cache_size=0)
+        dispatcher.add('a.*', first)
+        self.assertEqual(dispatcher.match('a.1'), (first,))
+        self.assertEqual(len(dispatcher._cache), 0)
+
+
+class DispatchReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = fake.Broker()
+        self.broker.exchanges['events'] = 'topic'
+        self.handled = []
+
+    def receiver(self, **kwargs):
+        receiver = Receiver(None, 'amqp://', 'events', queue='orders', **kwargs)
+        receiver.add_handler('order.created', lambda *args: self.handled.append('created'))
+        receiver.add_handler('order.paid', lambda *args: self.handled.append('paid'))
+        fake.start(receiver, self.broker)
+        return receiver
+
+    def publish(self, routing_key, headers):
+        self.broker.publish('events', routing_key, b'body',
+                            pika.BasicProperties(headers=headers))
+        self.broker.deliver()
+
+    def test_retry_routing_key_header(self):
+        self.receiver(retry_policy=RetryPolicy())
+        self.broker.publish('', 'orders', b'body', pika.BasicProperties(
+            headers={RetryPolicy.ROUTING_KEY_HEADER: 'order.paid'}))
+        self.broker.deliver()
+        self.assertEqual(self.handled, ['paid'])
+
+    def test_retry_routing_key_header_ignored_without_retry_policy(self):
+        self.receiver()
+        self.publish('order.created', {RetryPolicy.ROUTING_KEY_HEADER: 'order.paid'})
+        self.assertEqual(self.handled, ['created'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from rmq.rmqproducer.lanes import PriorityLanes
+
+
+class PriorityLanesTest(unittest.TestCase):
+
+    def drain(self, lanes):
+        order = []
+        while len(lanes):
+            order.append(lanes.get())
+        return order
+
+    def test_smooth_weighted_round_robin(self):
+        lanes = PriorityLanes({'a': 5, 'b': 1, 'c': 1})
+        for lane in ('a', 'b', 'c'):
+            for index in range(5):
+                lanes.put(lane, index)
+        picks = [lanes.get()[0] for _ in range(7)]
+        self.assertEqual(sorted(picks), ['a'] * 5 + ['b', 'c'])
+        # the heavy lane is interleaved rather than sent in one burst
+        self.assertNotEqual(picks[:5], ['a'] * 5)
+
+    def test_fifo_within_lane(self):
+        lanes = PriorityLanes({'a': 1, 'b': 2})
+        for index in range(3):
+            lanes.put('a', index)
+            lanes.put('b', index)
+        order = self.drain(lanes)
+        self.assertEqual([item for lane, item in order if lane == 'a'], [0, 1, 2])
+        self.assertEqual([item for lane, item in order if lane == 'b'], [0, 1, 2])
+
+    def test_empty_lanes_are_skipped(self):
+        lanes = PriorityLanes({'a': 10, 'b': 1})
+        lanes.put('b', 'x')
+        self.assertEqual(lanes.get(), ('b', 'x'))
+        self.assertRaises(IndexError, lanes.get)
+
+    def test_sizes_and_priority(self):
+        lanes = PriorityLanes({'critical': {'weight': 10, 'priority': 9}, 'bulk': 1})
+        lanes.put('bulk', 'x')
+        self.assertEqual(lanes.lane_sizes(), {'critical': 0, 'bulk': 1})
+        self.assertEqual(lanes.priority('critical'), 9)
+        self.assertIsNone(lanes.priority('bulk'))
+        self.assertRaises(KeyError, lanes.put, 'unknown', 'x')
+
+    def test_invalid_weight(self):
+        self.assertRaises(ValueError, PriorityLanes, {'a': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+
+import pika
+from pika import spec
+
+from rmq.rmqpipeline.pipeline_stage import PipelineStage
+from rmq.rmqreceiver.dedup import MessageIdCache
+from rmq.rmqreceiver.retry import RetryPolicy
+
+from tests import broker as fake
+
+
+class PipelineStageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = fake.Broker()
+        self.cache = MessageIdCache()
+        self.transformed = []
+        self.start(dedup_cache=self.cache)
+
+    def start(self, **kwargs):
+        self.stage = PipelineStage(self.transform, 'amqp://', '', 'out',
+                                   output_exchange_type='fanout', queue='in', **kwargs)
+        fake.start(self.stage, self.broker)
+        self.broker.declare_queue('sink')
+        self.broker.bindings.append(('out', 'sink', ''))
+        self.channel = self.stage._channel
+
+    def transform(self, channel, method, properties, body):
+        self.transformed.append(body)
+        if body == b'bad':
+            raise ValueError(body)
+        return [('key', body.upper())]
+
+    def publish(self, body, message_id):
+        self.broker.publish('', 'in', body, pika.BasicProperties(message_id=message_id))
+        self.broker.deliver()
+
+    def test_acknowledged_once_outputs_are_confirmed(self):
+        self.publish(b'a', 'm1')
+        self.publish(b'b', 'm2')
+        self.assertEqual(self.channel.acked, [])
+        self.assertFalse(self.cache.seen('m1'))
+        self.channel.confirm(multiple=True)
+        self.assertEqual(self.channel.acked, [1, 2])
+        self.assertTrue(self.cache.seen('m1'))
+        self.assertTrue(self.cache.seen('m2'))
+        outputs = [(properties.message_id, body) for exchange, routing_key, properties, body
+                   in self.broker.queues['sink'].messages]
+        self.assertEqual(outputs, [('m1.0', b'A'), ('m2.0', b'B')])
+
+    def test_rejected_message_is_not_a_duplicate_when_redelivered(self):
+        self.publish(b'a', 'm1')
+        self.channel.confirm(nack=True)
+        # requeued after requeue_delay
+        self.assertEqual(self.channel.nacked, [])
+        self.stage._connection.run_timeouts()
+        self.assertEqual(self.channel.nacked, [1])
+        self.assertFalse(self.cache.seen('m1'))
+        self.broker.deliver()
+        self.assertEqual(self.transformed, [b'a', b'a'])
+        self.channel.confirm()
+        self.assertEqual(self.channel.acked, [2])
+        self.assertTrue(self.cache.seen('m1'))
+
+    def test_unconfirmed_message_is_not_a_duplicate_after_reconnection(self):
+        self.publish(b'a', 'm1')
+        self.channel.close()
+        self.stage.on_channel_open(self.stage._connection.channel())
+        self.broker.deliver()
+        self.assertEqual(self.transformed, [b'a', b'a'])
+
+    def test_duplicate_is_acknowledged_right_away(self):
+        self.cache.add('m1')
+        self.publish(b'a', 'm1')
+        self.assertEqual(self.transformed, [])
+        self.assertEqual(self.channel.acked, [1])
+
+    def test_unsettled_failure_is_not_acknowledged_with_later_messages(self):
+        self.broker = fake.Broker()
+        self.start(retry_policy=RetryPolicy())
+        self.publish(b'bad', 'm1')
+        self.publish(b'b', 'm2')
+        # the output of m2 is confirmed before the retry of m1
+        self.stage.on_delivery_confirmation(fake._frame(spec.Basic.Ack(2)))
+        self.assertEqual(self.channel.acked, [2])
+        self.assertIn(1, self.channel.unacked)
+        self.stage.on_delivery_confirmation(fake._frame(spec.Basic.Ack(1)))
+        self.assertEqual(self.channel.acked, [2, 1])
+
+    def test_stream_offset_recorded_once_acknowledged(self):
+        self.broker = fake.Broker()
+        self.start(queue_type='stream')
+        self.publish(b'a', 'm1')
+        self.publish(b'b', 'm2')
+        self.assertIsNone(self.stage._stream_offset)
+        self.channel.confirm(1)
+        self.assertEqual(self.stage._stream_offset, 0)
+        self.channel.confirm()
+        self.assertEqual(self.stage._stream_offset, 1)
+
+    def test_incompatible_options(self):
+        self.assertRaises(ValueError, PipelineStage, self.transform, 'amqp://', '', 'out',
+                          queue='in', transfer_callback=self.transform)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import os
+import time
+import unittest
+
+import pika
+
+from rmq.rmqreceiver.process_pool import SharedMemoryPool, WorkerError, _Ring
+from rmq.rmqreceiver.rabbitmq_receiver import Receiver
+from rmq.rmqreceiver.retry import RetryPolicy
+
+from tests import broker as fake
+
+
+def handle(method, properties, body):
+    body = bytes(body)
+    if body == b'fail':
+        raise KeyError('fail')
+    if body == b'die':
+        os._exit(3)
+
+
+def wait_for(pool, count, timeout=10):
+    completed = []
+    deadline = time.time() + timeout
+    while len(completed) < count and time.time() < deadline:
+        completed.extend(pool.poll())
+        time.sleep(0.01)
+    return completed
+
+
+class RingTest(unittest.TestCase):
+
+    def test_wraps_around(self):
+        ring = _Ring(10)
+        first = ring.allocate(4)
+        second = ring.allocate(4)
+        self.assertEqual((first[0], second[0]), (0, 4))
+        self.assertIsNone(ring.allocate(4))
+        ring.free(first)
+        third = ring.allocate(4)
+        self.assertEqual(third[0], 0)
+        self.assertIsNone(ring.allocate(1))
+
+    def test_space_reused_after_older_regions_are_freed(self):
+        ring = _Ring(10)
+        first = ring.allocate(5)
+        second = ring.allocate(5)
+        ring.free(second)
+        self.assertIsNone(ring.allocate(5))
+        ring.free(first)
+        self.assertEqual(ring.allocate(10)[0], 0)
+
+    def test_too_large(self):
+        self.assertIsNone(_Ring(10).allocate(11))
+
+
+class SharedMemoryPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SharedMemoryPool(handle, processes=2, buffer_size=16)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_success_and_failure(self):
+        self.pool.submit('ok', None, None, b'fine')
+        self.pool.submit('large', None, None, b'x' * 100)
+        self.pool.submit('failed', None, None, b'fail')
+        completed = dict((token, (error, body))
+                         for token, error, body in wait_for(self.pool, 3))
+        self.assertEqual(completed['ok'], (None, None))
+        self.assertEqual(completed['large'], (None, None))
+        error, body = completed['failed']
+        self.assertIsInstance(error, KeyError)
+        self.assertEqual(body, b'fail')
+        self.assertEqual(self.pool.in_progress(), 0)
+
+    def test_dead_worker_is_replaced(self):
+        self.pool.submit('died', None, None, b'die')
+        [(token, error, body)] = wait_for(self.pool, 1)
+        self.assertEqual(token, 'died')
+        self.assertIsInstance(error, WorkerError)
+        self.assertEqual(body, b'die')
+        self.assertEqual(self.pool.in_progress(), 0)
+        self.assertEqual(len(self.pool._workers), 2)
+        self.pool.submit('ok', None, None, b'fine')
+        self.assertEqual(wait_for(self.pool, 1), [('ok', None, None)])
+
+    def test_close_returns_completions(self):
+        for token in ('a', 'b', 'c'):
+            self.pool.submit(token, None, None, b'fine')
+        completed = self.pool.close()
+        self.assertEqual(sorted(token for token, error, body in completed), ['a', 'b', 'c'])
+        self.assertEqual(self.pool.in_progress(), 0)
+
+    def test_resize(self):
+        self.pool.resize(3)
+        self.assertEqual(len(self.pool._workers), 3)
+        self.pool.resize(1)
+        self.assertEqual(self.pool.processes, 1)
+        deadline = time.time() + 10
+        while len(self.pool._workers) > 1 and time.time() < deadline:
+            self.pool.poll()
+            time.sleep(0.01)
+        self.assertEqual(len(self.pool._workers), 1)
+        self.pool.resize(2)
+        self.assertEqual(len(self.pool._workers), 2)
+
+
+class PoolReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = fake.Broker()
+        self.pool = SharedMemoryPool(handle, processes=1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def run_receiver(self, bodies, **kwargs):
+        receiver = Receiver(None, 'amqp://', '', queue='work',
+                            process_pool=self.pool, **kwargs)
+        fake.start(receiver, self.broker)
+        for body in bodies:
+            self.broker.publish('', 'work', body, pika.BasicProperties(headers={}))
+        self.broker.deliver()
+        self.wait_for_pool(receiver)
+        return receiver
+
+    def wait_for_pool(self, receiver):
+        deadline = time.time() + 10
+        while self.pool.in_progress() and time.time() < deadline:
+            for handler in list(receiver._connection.ioloop.handlers.values()):
+                handler(None, None)
+            time.sleep(0.01)
+
+    def test_failures_are_retried(self):
+        receiver = self.run_receiver([b'fine', b'fail', b'die'],
+                                     retry_policy=RetryPolicy())
+        self.assertEqual(receiver._channel.acked, [1])
+        receiver._channel.confirm()
+        self.assertEqual(sorted(receiver._channel.acked), [1, 2, 3])
+        retried = sorted(body for exchange, routing_key, body, properties
+                         in receiver._channel.published)
+        self.assertEqual(retried, [b'die', b'fail'])
+
+    def test_failures_are_rejected_without_retry_policy(self):
+        receiver = self.run_receiver([b'fine', b'fail'])
+        self.assertEqual(receiver._channel.acked, [1])
+        self.assertEqual(receiver._channel.nacked, [2])
+
+    def test_channel_closed_once_messages_in_progress_are_completed(self):
+        receiver = Receiver(None, 'amqp://', '', queue='work', process_pool=self.pool)
+        fake.start(receiver, self.broker)
+        channel = receiver._channel
+        self.broker.publish('', 'work', b'fine')
+        self.broker.deliver()
+        receiver._closing = True
+        receiver.stop_consuming()
+        self.assertTrue(channel.is_open)
+        self.wait_for_pool(receiver)
+        self.assertEqual(channel.acked, [1])
+        self.assertFalse(channel.is_open)
+
+    def test_incompatible_options(self):
+        self.assertRaises(ValueError, Receiver, None, 'amqp://', '', queue='work',
+                          process_pool=self.pool, transfer_callback=handle)
+        self.assertRaises(ValueError, Receiver, None, 'amqp://', '', queue='events',
+                          queue_type='stream', process_pool=self.pool)
+        receiver = Receiver(None, 'amqp://', '', queue='work', process_pool=self.pool)
+        self.assertRaises(ValueError, receiver.add_handler, '#', handle)
+
+
+if __name__ == '__main__':
+    unittest.main()
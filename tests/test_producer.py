@@ -0,0 +1,95 @@
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from rmq.rmqproducer.rabbitmq_producer import Publisher
+
+from tests import broker as fake
+
+
+class PublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = fake.Broker()
+        self.broker.declare_queue('sink')
+        self.broker.bindings.append(('events', 'sink', '#'))
+
+    def publisher(self, **kwargs):
+        def connect(publisher):
+            publisher._connection = self.broker.connect()
+            publisher.on_connection_open(publisher._connection)
+        with mock.patch.object(Publisher, 'connect', connect):
+            publisher = Publisher('amqp://', 'events', safe_stop=False, **kwargs)
+        self.channel = publisher._channel
+        return publisher
+
+    def confirm_on_ioloop(self, publisher, **kwargs):
+        """Let every run of the IOLoop deliver the oldest confirmation."""
+        runs = []
+
+        def start():
+            runs.append(len(publisher._messages))
+            self.channel.confirm(1, **kwargs)
+        publisher._connection.ioloop.start = start
+        return runs
+
+    def test_blocks_while_inflight_is_full(self):
+        publisher = self.publisher(max_inflight_messages=2)
+        runs = self.confirm_on_ioloop(publisher)
+        publisher.publish_message('a', 'key')
+        self.assertEqual(runs, [])
+        publisher.publish_message('b', 'key')
+        # the second message filled the window
+        self.assertEqual(runs, [2])
+        self.assertEqual(publisher.inflight_usage(), {'messages': 1, 'bytes': 1})
+        self.assertEqual(len(self.broker.queues['sink'].messages), 2)
+
+    def test_bytes_limit_counts_encoded_size(self):
+        publisher = self.publisher(max_inflight_messages=None, max_inflight_bytes=100)
+        publisher.publish_message(u'\xe9t\xe9', 'key')
+        self.assertEqual(publisher.inflight_usage(), {'messages': 1, 'bytes': 5})
+        publisher.publish_message(b'abc', 'key')
+        self.assertEqual(publisher.inflight_usage(), {'messages': 2, 'bytes': 8})
+
+    def test_multiple_ack_releases_several_messages(self):
+        publisher = self.publisher(max_inflight_messages=None)
+        for body in ('a', 'bb', 'ccc'):
+            publisher.publish_message(body, 'key')
+        self.channel.confirm(2, multiple=True)
+        self.assertEqual(publisher.inflight_usage(), {'messages': 1, 'bytes': 3})
+        self.assertEqual(list(publisher._messages), [3])
+
+    def test_nack_calls_nack_callback(self):
+        failed = []
+        publisher = self.publisher(max_inflight_messages=None, nack_callback=failed.append)
+        publisher.publish_message('a', 'key')
+        publisher.publish_message('b', 'key')
+        self.channel.confirm(nack=True, multiple=True)
+        self.assertEqual(failed, ['a', 'b'])
+        self.assertEqual(publisher.inflight_usage(), {'messages': 0, 'bytes': 0})
+
+    def test_no_state_without_delivery_confirmation(self):
+        publisher = self.publisher(delivery_confirmation=False)
+        for body in ('a', 'b', 'c'):
+            publisher.publish_message(body, 'key')
+        self.assertIsNone(self.channel.confirm_callback)
+        self.assertEqual(publisher._messages, {})
+        self.assertEqual(publisher.inflight_usage(), {'messages': 0, 'bytes': 0})
+        self.assertEqual(len(self.broker.queues['sink'].messages), 3)
+
+    def test_stop_waits_for_confirmations(self):
+        publisher = self.publisher(max_inflight_messages=None)
+        publisher.publish_message('a', 'key')
+        publisher.publish_message('b', 'key')
+        runs = self.confirm_on_ioloop(publisher)
+        publisher.stop()
+        self.assertEqual(runs[:2], [2, 1])
+        self.assertEqual(publisher._messages, {})
+        self.assertFalse(self.channel.is_open)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+
+import pika
+
+from rmq.rmqreceiver.rabbitmq_receiver import Receiver
+from rmq.rmqreceiver.retry import RetryPolicy
+
+from tests import broker as fake
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_delay_grows_and_is_capped(self):
+        policy = RetryPolicy(initial_delay=1, multiplier=2, max_delay=5)
+        self.assertEqual([policy.delay(attempts) for attempts in range(1, 6)],
+                         [1000, 2000, 4000, 5000, 5000])
+
+    def test_delays_are_distinct_and_sorted(self):
+        policy = RetryPolicy(max_retries=6, initial_delay=0.5, multiplier=3,
+                             max_delay=10)
+        self.assertEqual(policy.delays(), [500, 1500, 4500, 10000])
+
+    def test_constant_delay_needs_one_queue(self):
+        policy = RetryPolicy(max_retries=3, initial_delay=2, multiplier=1)
+        self.assertEqual(policy.delays(), [2000])
+
+    def test_should_retry(self):
+        policy = RetryPolicy(max_retries=2, retry_on=(IOError,))
+        self.assertTrue(policy.should_retry(IOError(), 1))
+        self.assertTrue(policy.should_retry(IOError(), 2))
+        self.assertFalse(policy.should_retry(IOError(), 3))
+        self.assertFalse(policy.should_retry(ValueError(), 1))
+
+    def test_queue_names_and_arguments(self):
+        policy = RetryPolicy()
+        self.assertEqual(policy.retry_queue('orders', 2000), 'orders.retry.2000')
+        self.assertEqual(policy.parking_queue('orders'), 'orders.parking')
+        self.assertEqual(policy.retry_queue_arguments('orders', 2000),
+                         {'x-message-ttl': 2000,
+                          'x-dead-letter-exchange': '',
+                          'x-dead-letter-routing-key': 'orders'})
+
+
+class RetryReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = fake.Broker()
+        self.received = []
+        self.receiver = Receiver(self.callback, 'amqp://', '', queue='orders',
+                                 retry_policy=RetryPolicy(max_retries=2))
+        fake.start(self.receiver, self.broker)
+        self.channel = self.receiver._channel
+
+    def callback(self, channel, method, properties, body):
+        self.received.append((body, dict(properties.headers or {})))
+        raise IOError('unavailable')
+
+    def publish(self, body):
+        self.broker.publish('', 'orders', body, pika.BasicProperties(headers={}))
+        self.broker.deliver()
+
+    def test_declares_retry_and_parking_queues(self):
+        queues = self.broker.queues
+        self.assertEqual(queues['orders.retry.1000'].arguments,
+                         {'x-message-ttl': 1000, 'x-dead-letter-exchange': '',
+                          'x-dead-letter-routing-key': 'orders'})
+        self.assertEqual(queues['orders.retry.2000'].arguments['x-message-ttl'], 2000)
+        self.assertEqual(queues['orders.parking'].arguments, {})
+        self.assertTrue(queues['orders.parking'].durable)
+        self.assertIsNotNone(self.channel.confirm_callback)
+
+    def test_retried_then_parked(self):
+        self.publish(b'a')
+        for retry_queue in ('orders.retry.1000', 'orders.retry.2000'):
+            self.assertEqual(len(self.broker.queues[retry_queue].messages), 1)
+            self.channel.confirm()
+            self.broker.expire(retry_queue)
+            self.broker.deliver()
+        self.assertEqual([headers.get(RetryPolicy.ATTEMPTS_HEADER)
+                          for body, headers in self.received], [None, 1, 2])
+        [(exchange, routing_key, properties, body)] = self.broker.queues['orders.parking'].messages
+        self.assertEqual(body, b'a')
+        self.assertEqual(properties.headers[RetryPolicy.ATTEMPTS_HEADER], 3)
+        self.assertEqual(properties.headers[RetryPolicy.ROUTING_KEY_HEADER], 'orders')
+        self.channel.confirm()
+        self.assertEqual(self.channel.acked, [1, 2, 3])
+
+    def test_acknowledged_once_republish_is_confirmed(self):
+        self.publish(b'a')
+        self.assertEqual(self.channel.acked, [])
+        self.assertEqual(list(self.channel.unacked), [1])
+        self.channel.confirm()
+        self.assertEqual(self.channel.acked, [1])
+
+    def test_requeued_when_republish_is_rejected(self):
+        self.publish(b'a')
+        self.channel.confirm(nack=True)
+        self.assertEqual(self.channel.nacked, [1])
+        self.assertEqual(self.channel.acked, [])
+        self.broker.deliver()
+        self.assertEqual(self.received[-1], (b'a', {}))
+
+    def test_unconfirmed_retries_are_dropped_with_the_channel(self):
+        self.publish(b'a')
+        self.channel.close()
+        self.receiver.on_channel_open(self.receiver._connection.channel())
+        self.assertEqual(self.receiver._unconfirmed_retries, {})
+
+    def test_rejects_stream_queue(self):
+        self.assertRaises(ValueError, Receiver, None, 'amqp://', '', queue='events',
+                          queue_type='stream', retry_policy=RetryPolicy())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pika
+
+from rmq.rmqrpc.rpc_client import (ERROR_HEADER, REPLY_TO, RpcClient, RpcError,
+                                   RpcTimeout)
+from rmq.rmqrpc.rpc_server import RpcServer
+
+from tests import broker as fake
+
+
+class RpcServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = fake.Broker()
+        self.broker.declare_queue('client.replies')
+
+    def serve(self, handler):
+        server = RpcServer(handler, 'amqp://', queue='service')
+        fake.start(server, self.broker)
+        self.broker.publish('', 'service', b'request', pika.BasicProperties(
+            correlation_id='c1', reply_to='client.replies'))
+        self.broker.deliver()
+        return server
+
+    def reply(self):
+        exchange, routing_key, properties, body = \
+            self.broker.queues['client.replies'].messages.popleft()
+        return properties, body
+
+    def test_reply(self):
+        server = self.serve(lambda channel, method, properties, body: body.upper())
+        properties, body = self.reply()
+        self.assertEqual(body, b'REQUEST')
+        self.assertEqual(properties.correlation_id, 'c1')
+        self.assertEqual(server._channel.acked, [1])
+
+    def test_none_is_an_empty_reply(self):
+        self.serve(lambda channel, method, properties, body: None)
+        properties, body = self.reply()
+        self.assertEqual(body, '')
+        self.assertIsNone(properties.headers)
+
+    def test_error_reply(self):
+        def fail(channel, method, properties, body):
+            raise KeyError('missing')
+        self.serve(fail)
+        properties, body = self.reply()
+        self.assertEqual(body, '')
+        self.assertEqual(properties.headers, {ERROR_HEADER: "KeyError('missing')"})
+
+
+class RpcClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = fake.Broker()
+        self.broker.declare_queue(REPLY_TO)
+        self.broker.declare_queue('service')
+        self.now = 100
+
+        def connect(client):
+            client._connection = self.broker.connect()
+            client.on_connection_open(client._connection)
+        with mock.patch.object(RpcClient, 'connect', connect):
+            self.client = RpcClient('amqp://', timeout=5)
+        self.connection = self.client._connection
+        self.connection.ioloop.stop = mock.Mock()
+
+    def time(self):
+        return self.now
+
+    def requests(self):
+        return [properties.correlation_id for exchange, routing_key, properties, body
+                in self.broker.queues['service'].messages]
+
+    def reply(self, correlation_id, body, headers=None):
+        self.broker.publish('', REPLY_TO, body, pika.BasicProperties(
+            correlation_id=correlation_id, headers=headers))
+        self.broker.deliver()
+
+    def test_replies_are_matched_by_correlation_id(self):
+        first = self.client.call_async('service', b'a')
+        second = self.client.call_async('service', b'b')
+        self.assertEqual(self.requests(), [first.correlation_id, second.correlation_id])
+        self.assertEqual(self.client.pending_calls(), 2)
+        self.reply(second.correlation_id, b'B')
+        self.assertFalse(first.done())
+        self.assertEqual(second.result(), b'B')
+        self.reply(first.correlation_id, b'A')
+        self.assertEqual(first.result(), b'A')
+        self.assertEqual(first.properties.correlation_id, first.correlation_id)
+        self.assertEqual(self.client.pending_calls(), 0)
+        # replies to unknown calls are dropped
+        self.reply('unknown', b'X')
+
+    def test_result_runs_ioloop_until_reply(self):
+        future = self.client.call_async('service', b'a')
+        self.connection.ioloop.start = lambda: self.reply(future.correlation_id, b'A')
+        self.assertEqual(future.result(), b'A')
+        self.connection.ioloop.stop.assert_called_once_with()
+
+    def test_error_reply(self):
+        future = self.client.call_async('service', b'a')
+        self.reply(future.correlation_id, b'', {ERROR_HEADER: 'KeyError()'})
+        self.assertRaises(RpcError, future.result)
+
+    def test_timeout(self):
+        with mock.patch('time.time', self.time):
+            future = self.client.call_async('service', b'a', timeout=1)
+            later = self.client.call_async('service', b'b')
+            self.now = 102
+            self.assertRaises(RpcTimeout, future.result)
+            self.assertFalse(later.done())
+            self.assertEqual(self.client.pending_calls(), 1)
+            self.reply(future.correlation_id, b'late')
+            self.assertEqual(self.client.pending_calls(), 1)
+
+    def test_deadline_timer_fails_calls_followed_by_callbacks(self):
+        completed = []
+        with mock.patch('time.time', self.time):
+            self.client.call_async('service', b'a', timeout=3).add_done_callback(
+                completed.append)
+            self.client.call_async('service', b'b', timeout=1).add_done_callback(
+                completed.append)
+            # one timer, moved to the earliest deadline
+            self.assertEqual([delay for delay, _ in self.connection.timeouts], [1])
+            self.now = 101
+            self.connection.run_timeouts()
+            self.assertEqual(len(completed), 1)
+            self.assertRaises(RpcTimeout, completed[0].result)
+            self.assertEqual([delay for delay, _ in self.connection.timeouts], [2])
+            self.now = 103
+            self.connection.run_timeouts()
+        self.assertEqual(len(completed), 2)
+        self.assertEqual(self.connection.timeouts, [])
+
+    def test_lost_connection_fails_pending_calls(self):
+        future = self.client.call_async('service', b'a')
+        other = self.client.call_async('service', b'b')
+        self.connection.ioloop.start = lambda: self.client.on_connection_closed(
+            self.connection, 320, 'forced')
+        self.assertRaises(RpcError, future.result)
+        self.assertRaises(RpcError, other.result)
+        self.connection.ioloop.stop.assert_called_once_with()
+        self.assertEqual(self.client.pending_calls(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
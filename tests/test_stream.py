@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rmq.rmqreceiver.offsets import OffsetCheckpoint
+from rmq.rmqreceiver.rabbitmq_receiver import Receiver
+
+from tests import broker as fake
+
+
+class StreamReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.directory, 'offset')
+        self.broker = fake.Broker()
+        self.received = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def callback(self, channel, method, properties, body):
+        self.received.append(body)
+
+    def receiver(self, **kwargs):
+        kwargs.setdefault('offset_checkpoint', self.checkpoint)
+        kwargs.setdefault('checkpoint_interval', 0)
+        receiver = Receiver(self.callback, 'amqp://', '', queue='events',
+                            queue_type='stream', queue_durable=False,
+                            queue_exclusive=True, no_ack=True, **kwargs)
+        fake.start(receiver, self.broker)
+        return receiver
+
+    def publish(self, *bodies):
+        for body in bodies:
+            self.broker.publish('', 'events', body)
+        self.broker.deliver()
+
+    def test_declares_and_consumes_stream(self):
+        receiver = self.receiver()
+        queue = self.broker.queues['events']
+        self.assertEqual(queue.arguments, {'x-queue-type': 'stream'})
+        self.assertTrue(queue.durable)
+        self.assertFalse(queue.exclusive)
+        channel = receiver._channel
+        self.assertEqual(channel.prefetch_count, 1000)
+        consumer = queue.consumers[0]
+        self.assertFalse(consumer.no_ack)
+        self.assertEqual(consumer.arguments, {'x-stream-offset': 'next'})
+        self.publish(b'a', b'b')
+        self.assertEqual(self.received, [b'a', b'b'])
+        self.assertEqual(channel.acked, [1, 2])
+
+    def test_stream_offset(self):
+        self.broker.declare_queue('events', arguments={'x-queue-type': 'stream'})
+        self.broker.publish('', 'events', b'old')
+        self.receiver(stream_offset='first', offset_checkpoint=None)
+        self.publish(b'new')
+        self.assertEqual(self.received, [b'old', b'new'])
+
+    def test_resumes_after_checkpoint(self):
+        receiver = self.receiver()
+        self.publish(b'a', b'b', b'c')
+        receiver._offset_checkpoint.close()
+        with open(self.checkpoint) as checkpoint_file:
+            self.assertEqual(checkpoint_file.read(), '2\n')
+        receiver._channel.close()
+        self.broker.publish('', 'events', b'd')
+
+        self.received = []
+        self.receiver(stream_offset='first')
+        self.assertEqual(self.broker.queues['events'].consumers[0].arguments,
+                         {'x-stream-offset': 3})
+        self.broker.deliver()
+        self.assertEqual(self.received, [b'd'])
+
+    def test_resumes_on_new_channel(self):
+        receiver = self.receiver(offset_checkpoint=None)
+        self.publish(b'a')
+        receiver._channel.close()
+        receiver.on_channel_open(receiver._connection.channel())
+        self.assertEqual(self.broker.queues['events'].consumers[0].arguments,
+                         {'x-stream-offset': 1})
+
+    def test_requires_named_queue(self):
+        self.assertRaises(ValueError, Receiver, self.callback, 'amqp://', '',
+                          queue_type='stream')
+
+
+class OffsetCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'offset')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_saved_at_interval_and_on_close(self):
+        checkpoint = OffsetCheckpoint(self.path, interval=3600)
+        self.assertIsNone(checkpoint.offset)
+        checkpoint.update(7)
+        self.assertIsNone(OffsetCheckpoint(self.path).offset)
+        checkpoint.close()
+        self.assertEqual(OffsetCheckpoint(self.path).offset, 7)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_unreadable_checkpoint(self):
+        with open(self.path, 'w') as checkpoint_file:
+            checkpoint_file.write('garbage')
+        self.assertIsNone(OffsetCheckpoint(self.path).offset)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pika
+
+from rmq.rmqproducer.rabbitmq_producer import Publisher
+from rmq.rmqtraffic import replay
+from rmq.rmqtraffic.recorder import TrafficRecorder
+from rmq.rmqtraffic.trafficlog import TrafficReader, TrafficWriter
+
+from tests import broker as fake
+
+
+class TrafficLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'traffic.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        writer = TrafficWriter(self.path)
+        writer.write('order.created', {'message_id': 'a', 'headers': {'x': b'y'}},
+                     b'\x00\x01', timestamp=100.0)
+        writer.write(None, {}, u'caf\xe9', timestamp=102.5)
+        writer.close()
+        reader = TrafficReader(self.path)
+        records = list(reader)
+        reader.close()
+        self.assertEqual(records, [
+            (0.0, 'order.created', {'message_id': 'a', 'headers': {'x': 'y'}}, b'\x00\x01'),
+            (2.5, '', {}, u'caf\xe9'.encode('utf-8'))])
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as log_file:
+            log_file.write(b'not a log')
+        self.assertRaises(ValueError, TrafficReader, self.path)
+
+
+class TrafficRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'traffic.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_binds_every_routing_key_by_default(self):
+        recorder = TrafficRecorder(self.path, 'amqp://', 'events')
+        self.assertEqual(recorder.binding_keys, ['#'])
+        recorder._writer.close()
+
+    def test_requires_max_messages_without_acks(self):
+        self.assertRaises(ValueError, TrafficRecorder, self.path, 'amqp://', 'events',
+                          ack_captured=False)
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'traffic.log')
+        self.source = fake.Broker()
+        self.source.exchanges['events'] = 'topic'
+        self.target = fake.Broker()
+        self.target.declare_queue('sink')
+        self.target.bindings.append(('events', 'sink', '#'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, *messages):
+        recorder = TrafficRecorder(self.path, 'amqp://', 'events')
+        fake.start(recorder, self.source)
+        for routing_key, message_id, body in messages:
+            self.source.publish('events', routing_key, body,
+                                pika.BasicProperties(message_id=message_id))
+        self.source.deliver()
+        recorder._writer.close()
+
+    def connect(self):
+        """Patch Publisher.connect() to connect to the target broker, where
+        every run of the IOLoop confirms the messages published so far.
+
+        """
+        def connect(publisher):
+            connection = self.target.connect()
+            publisher._connection = connection
+            publisher.on_connection_open(connection)
+            connection.ioloop.start = lambda: connection.channels[-1].confirm()
+        return mock.patch.object(Publisher, 'connect', connect)
+
+    def replayed(self):
+        return [(routing_key, properties.message_id, body) for exchange, routing_key,
+                properties, body in self.target.queues['sink'].messages]
+
+    def test_replay(self):
+        self.record(('order.created', 'a', b'1'), ('order.paid', 'b', b'2'))
+        with self.connect():
+            publisher = Publisher('amqp://', 'events', safe_stop=False,
+                                  max_inflight_messages=None)
+        published, elapsed = replay.replay(self.path, publisher, speed=0,
+                                           keep_message_ids=True)
+        self.assertEqual(published, 2)
+        self.assertEqual(self.replayed(), [('order.created', 'a', b'1'),
+                                           ('order.paid', 'b', b'2')])
+        self.assertEqual(publisher.inflight_usage(), {'messages': 0, 'bytes': 0})
+
+    def test_entry_point(self):
+        self.record(('order.created', 'a', b'1'))
+        stdout = io.StringIO() if str is not bytes else io.BytesIO()
+        with self.connect(), \
+                mock.patch('signal.signal'), mock.patch('sys.stdout', stdout):
+            replay.main([self.path, 'amqp://', 'events', '--speed', '0'])
+        [(routing_key, message_id, body)] = self.replayed()
+        self.assertEqual((routing_key, body), ('order.created', b'1'))
+        # new message ids unless --keep-message-ids is given
+        self.assertNotEqual(message_id, 'a')
+        self.assertTrue(stdout.getvalue().startswith('Published 1 messages in'))
+
+
+if __name__ == '__main__':
+    unittest.main()